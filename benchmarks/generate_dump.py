@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Synthetic changeset dumps for benchmarking. Changesets look like those
+of the planet dump: increasing ids and timestamps, bounding boxes of
+varied size (or none), tags, discussions and a mix of open and closed
+changesets. A given fraction of them are centred in the Philippines.
+
+'''
+import argparse
+import bz2
+import gzip
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape, quoteattr
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import geog
+
+GEOJSON_DIR = os.path.join(REPO_DIR, 'GeoJSON')
+
+EDITORS = ['JOSM/1.5 (18678 en)', 'iD 2.27.3', 'StreetComplete 53.1', 'Every Door Android 5.0',
+           'Go Map!! 4.0', 'Vespucci 19.0.3.0', 'OsmAnd Maps 4.6', 'Potlatch 2.3', 'MAPS.ME ios 12.3']
+USERS = ['mapper', 'Juan dela Cruz', 'ñandú', 'A&B mapping', '<bot>', 'quote"user', 'Maria']
+COMMENTS = ['Added buildings', 'Fixed road alignment in barangay', 'Sari-sari stores & schools',
+            'Traced from imagery #hotosm-project-1234', 'Typo fix <b>', 'Added\ttabbed\nnames']
+SOURCES = ['Bing', 'Esri World Imagery', 'survey', 'Maxar', 'local knowledge']
+
+def open_output(path):
+    """Open a dump for writing, compressed according to its extension."""
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'wb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+def philippine_points(count, rng, geojson_dir=GEOJSON_DIR):
+    """Return arrays of count random points inside the national outline."""
+    national = geog.NationalFilter.from_file(os.path.join(geojson_dir, 'l2_national.geojson'))
+    lons, lats = np.empty(0), np.empty(0)
+    while len(lons) < count:
+        candidate_lons = rng.uniform(national.min_lon, national.max_lon, count * 4)
+        candidate_lats = rng.uniform(national.min_lat, national.max_lat, count * 4)
+        inside = national.contains_many(candidate_lons, candidate_lats)
+        lons = np.concatenate((lons, candidate_lons[inside]))
+        lats = np.concatenate((lats, candidate_lats[inside]))
+    return lons[:count], lats[:count]
+
+def synthetic_changesets(count, phFraction=0.05, openFraction=0.02, seed=0,
+                         firstId=1, start=datetime(2021, 1, 1), geojson_dir=GEOJSON_DIR):
+    """Yield changesets as (attribute dict, tag dict, comment list) tuples."""
+    rng = np.random.default_rng(seed)
+    inPh = rng.random(count) < phFraction
+    lons = rng.uniform(-180, 180, count)
+    lats = np.degrees(np.arcsin(rng.uniform(-0.95, 0.95, count)))
+    nPh = int(np.count_nonzero(inPh))
+    if nPh:
+        lons[inPh], lats[inPh] = philippine_points(nPh, rng, geojson_dir)
+    # Most edits are local, a few span whole regions
+    halfWidths = np.minimum(rng.lognormal(-6, 2, count), 5)
+    halfHeights = halfWidths * rng.uniform(0.5, 2, count)
+    noBbox = rng.random(count) < 0.03
+    isOpen = rng.random(count) < openFraction
+    seconds = np.cumsum(rng.exponential(2.0, count))
+    for i in range(count):
+        created = start + timedelta(seconds=float(seconds[i]))
+        attrib = {'id': str(firstId + i), 'created_at': created.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        if isOpen[i]:
+            attrib['open'] = 'true'
+        else:
+            closed = created + timedelta(seconds=float(rng.exponential(600)))
+            attrib['closed_at'] = closed.strftime('%Y-%m-%dT%H:%M:%SZ')
+            attrib['open'] = 'false'
+        attrib['user'] = USERS[rng.integers(len(USERS))]
+        attrib['uid'] = str(rng.integers(1, 20000))
+        if not noBbox[i]:
+            attrib['min_lat'] = '{:.7f}'.format(max(lats[i] - halfHeights[i], -90))
+            attrib['min_lon'] = '{:.7f}'.format(max(lons[i] - halfWidths[i], -180))
+            attrib['max_lat'] = '{:.7f}'.format(min(lats[i] + halfHeights[i], 90))
+            attrib['max_lon'] = '{:.7f}'.format(min(lons[i] + halfWidths[i], 180))
+        tags = {'created_by': EDITORS[rng.integers(len(EDITORS))],
+                'comment': COMMENTS[rng.integers(len(COMMENTS))]}
+        if rng.random() < 0.5:
+            tags['source'] = SOURCES[rng.integers(len(SOURCES))]
+        if rng.random() < 0.3:
+            tags['imagery_used'] = 'Bing aerial imagery'
+        comments = []
+        if rng.random() < 0.05:
+            for j in range(rng.integers(1, 4)):
+                date = created + timedelta(hours=float(j + 1))
+                comments.append({'date': date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                 'uid': str(rng.integers(1, 20000)),
+                                 'user': USERS[rng.integers(len(USERS))],
+                                 'text': COMMENTS[rng.integers(len(COMMENTS))]})
+        attrib['comments_count'] = str(len(comments))
+        attrib['num_changes'] = str(rng.integers(1, 500))
+        yield attrib, tags, comments
+
+def changeset_xml(attrib, tags, comments):
+    """Return the XML of a changeset as it appears in a dump."""
+    head = ' <changeset ' + ' '.join('{}={}'.format(k, quoteattr(v)) for k, v in attrib.items())
+    lines = [head + '>']
+    for k, v in tags.items():
+        lines.append('  <tag k={} v={}/>'.format(quoteattr(k), quoteattr(v)))
+    if comments:
+        lines.append('  <discussion>')
+        for comment in comments:
+            lines.append('   <comment date={} uid={} user={}>'.format(
+                quoteattr(comment['date']), quoteattr(comment['uid']), quoteattr(comment['user'])))
+            lines.append('    <text>{}</text>'.format(escape(comment['text'])))
+            lines.append('   </comment>')
+        lines.append('  </discussion>')
+    lines.append(' </changeset>')
+    return '\n'.join(lines) + '\n'
+
+def write_dump(path, changesets, timestamp=None):
+    """Write changesets to a dump file. Returns the number written."""
+    count = 0
+    timestamp = timestamp or datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    with open_output(path) as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm license="http://opendatacommons.org/licenses/odbl/1-0/" version="0.6" generator="generate_dump.py" timestamp="{}">\n'.format(timestamp).encode())
+        f.write(b' <bound box="-90,-180,90,180" origin="generate_dump.py"/>\n')
+        for changeset in changesets:
+            f.write(changeset_xml(*changeset).encode('utf-8'))
+            count += 1
+        f.write(b'</osm>\n')
+    return count
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Write a synthetic changeset dump for benchmarking.")
+    argParser.add_argument('output', help='Output file; .bz2 and .gz are compressed')
+    argParser.add_argument('-n', '--count', type=int, default=100000, help='Number of changesets (default 100000)')
+    argParser.add_argument('--ph-fraction', type=float, default=0.05, help='Fraction of changesets in the Philippines (default 0.05)')
+    argParser.add_argument('--open-fraction', type=float, default=0.02, help='Fraction of open changesets (default 0.02)')
+    argParser.add_argument('--first-id', type=int, default=1, help='Id of the first changeset (default 1)')
+    argParser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    args = argParser.parse_args()
+    written = write_dump(args.output, synthetic_changesets(
+        args.count, args.ph_fraction, args.open_fraction, args.seed, args.first_id))
+    print('wrote {:,} changesets to {}'.format(written, args.output))
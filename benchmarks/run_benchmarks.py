@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''
+Benchmarks of each ingest stage on a synthetic dump, written as JSON so
+results can be compared between versions:
+
+parse       scan and parse every changeset of the dump
+scan        scan the dump, parsing only changesets near the Philippines
+centroid    per-changeset calculate_centroid and check_if_in_philippines
+centroids   vectorized centroids and national filter
+locate_*    admin-area lookup of points in the Philippines (locate_postgis
+            needs -d)
+insert_*    batch loading into PostgreSQL (needs -d)
+indexes     post-load index build (needs -d)
+replication applying a replication file to loaded tables (needs -d)
+
+Database stages run in a schema of their own, dropped beforehand.
+
+'''
+import argparse
+import functools
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import numpy as np
+from shapely.geometry import Point
+
+from generate_dump import REPO_DIR, synthetic_changesets, write_dump
+sys.path.insert(0, REPO_DIR)
+import boundaries
+import geog
+import indexes
+import inputs
+import postgis
+import scanner
+from changesetmd import ChangesetMD, GEOLOCATE_BATCH_SIZE
+
+SCHEMA = 'changesetmd_bench'
+ALL_STAGES = ['parse', 'scan', 'centroid', 'centroids', 'locate_scalar', 'locate_exact',
+              'locate_cached', 'locate_grid', 'locate_postgis', 'insert_batch', 'insert_copy', 'indexes', 'replication']
+DB_STAGES = ['locate_postgis', 'insert_batch', 'insert_copy', 'indexes', 'replication']
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(stage, items, function, repeat, setup=None):
+    """
+    Run function repeat times and return the result of the stage, rated
+    on the fastest run. setup() runs untimed before each run.
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        startTime = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - startTime)
+    best = min(runs)
+    result = {'stage': stage, 'items': items, 'seconds': best, 'runs': runs,
+              'items_per_second': items / best if best > 0 else None}
+    print('{:<14} {:>10,} items {:>9.3f}s {:>14,.0f} /s'.format(
+        stage, items, best, result['items_per_second'] or 0))
+    return result
+
+def scan_dump(path, accept):
+    changesetFile = inputs.open_changeset_file(path)
+    changesetScanner = scanner.ChangesetScanner(changesetFile, accept)
+    records = list(changesetScanner)
+    changesetFile.close()
+    return changesetScanner.parsedCount, records
+
+def bbox_arrays(records):
+    """Return float arrays of min_lon, max_lon, min_lat, max_lat of records."""
+    return tuple(np.array([float(attrib[x]) for attrib, tags, comments in records])
+                 for x in ('min_lon', 'max_lon', 'min_lat', 'max_lat'))
+
+def geolocated_rows(md, locator, records):
+    changesets, comments = [], []
+    for i in range(0, len(records), GEOLOCATE_BATCH_SIZE):
+        md.geolocateRecords(locator, records[i:i + GEOLOCATE_BATCH_SIZE], changesets, comments)
+    return changesets, comments
+
+def run_cpu_stages(args, stages, dumpPath, locator):
+    results = []
+    parsedCount, records = scan_dump(dumpPath, lambda *bbox: True)
+    if 'parse' in stages:
+        results.append(measure('parse', parsedCount,
+                               lambda: scan_dump(dumpPath, lambda *bbox: True), args.repeat))
+    if 'scan' in stages:
+        results.append(measure('scan', parsedCount,
+                               lambda: scan_dump(dumpPath, locator.national.envelope_contains), args.repeat))
+    min_lon, max_lon, min_lat, max_lat = bbox_arrays(records)
+    if 'centroid' in stages:
+        def centroid():
+            for attrib, tags, comments in records:
+                point = Point(geog.calculate_centroid(attrib['min_lon'], attrib['max_lon'],
+                                                      attrib['min_lat'], attrib['max_lat']))
+                geog.check_if_in_philippines(locator.ph_polygon, point)
+        results.append(measure('centroid', len(records), centroid, args.repeat))
+    if 'centroids' in stages:
+        def centroids():
+            lons, lats = geog.calculate_centroids(min_lon, max_lon, min_lat, max_lat)
+            locator.contains_many(lons, lats)
+        results.append(measure('centroids', len(records), centroids, args.repeat))
+
+    lons, lats = geog.calculate_centroids(min_lon, max_lon, min_lat, max_lat)
+    inside = locator.contains_many(lons, lats)
+    lons, lats = lons[inside], lats[inside]
+    if 'locate_scalar' in stages:
+        # The original per-feature scan, on a sample as it is slow
+        with open(os.path.join(REPO_DIR, 'GeoJSON', 'l3_regions.geojson')) as f:
+            regions = json.load(f)
+        points = [Point(x, y) for x, y in zip(lons[:args.scalar_sample], lats[:args.scalar_sample])]
+        results.append(measure('locate_scalar', len(points),
+                               lambda: [geog.locate_in_philippines(regions, x) for x in points], args.repeat))
+    if 'locate_exact' in stages:
+        results.append(measure('locate_exact', len(lons), lambda: locator.locate_many(lons, lats), args.repeat))
+    if 'locate_cached' in stages:
+        cached = geog.CachedLocator(locator)
+        results.append(measure('locate_cached', len(lons), lambda: cached.locate_many(lons, lats), args.repeat))
+        results[-1]['cache'] = cached.stats()
+    if 'locate_grid' in stages:
+        grid = boundaries.load_grid(locator)
+        if grid is None:
+            print('skipping locate_grid')
+        else:
+            results.append(measure('locate_grid', len(lons), lambda: grid.locate_many(lons, lats), args.repeat))
+    return results, records
+
+def run_db_stages(args, stages, records, locator, workDir):
+    import psycopg2
+    import psycopg2.extras
+    connect = functools.partial(psycopg2.connect, database=args.dbName, user=args.dbUser,
+                                password=args.dbPass, host=args.dbHost, port=args.dbPort,
+                                options='-c search_path={},public'.format(SCHEMA))
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}'.format(SCHEMA))
+    conn.commit()
+    results = []
+    if 'locate_postgis' in stages:
+        postgis.ensure_boundaries(conn)
+        postgisLocator = postgis.PostgisLocator(connect, locator)
+        lons, lats = geog.calculate_centroids(*bbox_arrays(records))
+        inside = locator.contains_many(lons, lats)
+        lons, lats = lons[inside], lats[inside]
+        def locate():
+            for i in range(0, len(lons), GEOLOCATE_BATCH_SIZE):
+                postgisLocator.locate_many(lons[i:i + GEOLOCATE_BATCH_SIZE], lats[i:i + GEOLOCATE_BATCH_SIZE])
+        results.append(measure('locate_postgis', len(lons), locate, args.repeat))
+    md = ChangesetMD(args.createGeometry, partitioned=args.partitioned, connect=connect)
+    md.createTables(conn)
+    psycopg2.extras.register_hstore(conn)
+    changesets, comments = geolocated_rows(md, locator, records)
+
+    def load(useCopy):
+        md.useCopy = useCopy
+        for i in range(0, len(changesets), 10000):
+            md.flushBatch(conn, changesets[i:i + 10000], [], False)
+        md.flushBatch(conn, [], comments, False)
+        conn.commit()
+    for stage, useCopy in (('insert_batch', False), ('insert_copy', True)):
+        if stage in stages:
+            results.append(measure(stage, len(changesets), functools.partial(load, useCopy), args.repeat,
+                                   lambda: md.truncateTables(conn)))
+    if 'indexes' in stages or 'replication' in stages:
+        if not any(x in stages for x in ('insert_batch', 'insert_copy')):
+            md.truncateTables(conn)
+            load(True)
+        buildIndexes = lambda: indexes.build_indexes(connect, args.createGeometry, partitioned=args.partitioned)
+        if 'indexes' in stages:
+            results.append(measure('indexes', len(changesets), buildIndexes, 1))
+        else:
+            buildIndexes()
+    if 'replication' in stages:
+        # Half updates of loaded changesets, half new ones
+        replicationCount = max(1, args.count // 100)
+        replicationPath = os.path.join(workDir, 'replication.osm.gz')
+        write_dump(replicationPath, synthetic_changesets(
+            replicationCount, args.ph_fraction, args.open_fraction, args.seed + 1,
+            firstId=args.count - replicationCount // 2))
+        def replicate():
+            with gzip.open(replicationPath, 'rb') as f:
+                md.parseFile(conn, f, True)
+            conn.commit()
+        results.append(measure('replication', replicationCount, replicate, args.repeat))
+    conn.close()
+    return results
+
+def compare(results, baselinePath):
+    """Print the change in rate of each stage against an earlier result file."""
+    with open(baselinePath) as f:
+        baseline = {x['stage']: x for x in json.load(f)['results']}
+    for result in results:
+        before = baseline.get(result['stage'])
+        if before and before['items_per_second'] and result['items_per_second']:
+            change = result['items_per_second'] / before['items_per_second'] - 1
+            print('{:<14} {:+.1%}'.format(result['stage'], change))
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Benchmark the ingest stages on a synthetic changeset dump.")
+    argParser.add_argument('-n', '--count', type=int, default=100000, help='Number of changesets in the dump (default 100000)')
+    argParser.add_argument('--ph-fraction', type=float, default=0.05, help='Fraction of changesets in the Philippines (default 0.05)')
+    argParser.add_argument('--open-fraction', type=float, default=0.02, help='Fraction of open changesets (default 0.02)')
+    argParser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    argParser.add_argument('--dump', help='Benchmark this dump file instead of generating one')
+    argParser.add_argument('--work-dir', default=os.path.join(REPO_DIR, 'benchmarks', 'work'), help='Directory for generated files')
+    argParser.add_argument('--stages', nargs='+', choices=ALL_STAGES, default=ALL_STAGES, help='Stages to run (default all)')
+    argParser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the fastest is reported (default 3)')
+    argParser.add_argument('--scalar-sample', type=int, default=200, help='Points for locate_scalar (default 200)')
+    argParser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON result file (default benchmark_results.json)')
+    argParser.add_argument('--compare', help='Earlier JSON result file to compare with')
+    argParser.add_argument('-H', '--host', action='store', dest='dbHost', help='Database hostname')
+    argParser.add_argument('-P', '--port', action='store', dest='dbPort', default=None, help='Database port')
+    argParser.add_argument('-u', '--user', action='store', dest='dbUser', default=None, help='Database username')
+    argParser.add_argument('-p', '--password', action='store', dest='dbPass', default=None, help='Database password')
+    argParser.add_argument('-d', '--database', action='store', dest='dbName', help='Database for the locate_postgis, insert, indexes and replication stages')
+    argParser.add_argument('-g', '--geometry', action='store_true', dest='createGeometry', default=False, help='Load geometries (requires PostGIS)')
+    argParser.add_argument('--partitioned', action='store_true', default=False, help='Use partitioned tables')
+    args = argParser.parse_args()
+
+    outputPath = os.path.abspath(args.output)
+    comparePath = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(args.work_dir, exist_ok=True)
+    if args.dump:
+        dumpPath = os.path.abspath(args.dump)
+    else:
+        dumpPath = os.path.join(args.work_dir, 'dump-{}-{}-{}.osm.bz2'.format(args.count, args.ph_fraction, args.seed))
+        if not os.path.exists(dumpPath):
+            write_dump(dumpPath, synthetic_changesets(args.count, args.ph_fraction, args.open_fraction, args.seed))
+            print('generated ' + dumpPath)
+    # Boundary and reference files are found relative to the repository
+    os.chdir(REPO_DIR)
+    locator = boundaries.load_locator()
+
+    results, records = run_cpu_stages(args, args.stages, dumpPath, locator)
+    stages = [x for x in args.stages if x in DB_STAGES]
+    if stages and args.dbName is None:
+        print('skipping database stages, no database given')
+    elif stages:
+        results += run_db_stages(args, stages, records, locator, args.work_dir)
+
+    report = {
+        'version': git_version(),
+        'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'parameters': {'count': args.count, 'ph_fraction': args.ph_fraction, 'open_fraction': args.open_fraction,
+                       'seed': args.seed, 'dump': args.dump, 'repeat': args.repeat},
+        'results': results,
+    }
+    with open(outputPath, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to ' + outputPath)
+    if comparePath:
+        compare(results, comparePath)
@@ -0,0 +1,213 @@
+'''
+Compiled boundary artifact. The geometries and lookup tables that
+geog.PhilippinesLocator needs are packed as WKB behind a memory-mapped
+offset index, so a parse can start without re-reading the Overpass
+GeoJSON files. The artifact records the hashes of the files it was
+compiled from.
+
+'''
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import shapely
+import geog
+
+MAGIC = b'PHBNDRY\x00'
+FORMAT_VERSION = 2
+LEVELS = ['regions', 'provinces', 'cities']
+SETS_PATH = 'GeoJSON/boundary_sets.json'
+
+def boundary_sets(path=SETS_PATH):
+    """
+    Return (valid_from, GeoJSON directory) of each boundary set, oldest
+    first. Each set is in effect from its valid_from (None for the
+    first) until the next one's. Without a manifest at path, the
+    GeoJSON directory is the only set.
+    """
+    if not os.path.exists(path):
+        return [(None, 'GeoJSON')]
+    with open(path) as f:
+        manifest = json.load(f)
+    sets = sorted(((x.get('valid_from'), x['directory']) for x in manifest),
+                  key=lambda x: x[0] or '')
+    if any(x[0] is None for x in sets[1:]):
+        raise ValueError(path + ': only the oldest boundary set may have no valid_from')
+    return sets
+
+def compiled_path(geojson_dir):
+    return os.path.join(geojson_dir, 'boundaries.bin')
+
+def grid_path(geojson_dir):
+    return os.path.join(geojson_dir, 'admin_grid.npz')
+
+def source_paths(geojson_dir='GeoJSON'):
+    return {name: f'{geojson_dir}/{name}.geojson' for name in geog.GEOJSON_LAYERS}
+
+def source_hashes(geojson_dir='GeoJSON'):
+    """Return sha256 of each source GeoJSON file."""
+    hashes = {}
+    for name, path in source_paths(geojson_dir).items():
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        hashes[name] = digest.hexdigest()
+    return hashes
+
+def source_stats(geojson_dir='GeoJSON'):
+    """Return [size, mtime] of each source GeoJSON file, or None if missing."""
+    stats = {}
+    for name, path in source_paths(geojson_dir).items():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        stats[name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def compile_boundaries(geojson_dir='GeoJSON', path=None):
+    """
+    Build the locator from the GeoJSON files and write it to path.
+    Returns the artifact header.
+    """
+    path = path or compiled_path(geojson_dir)
+    locator = geog.PhilippinesLocator.from_files(geojson_dir)
+    geometries = [locator.ph_polygon]
+    levels = {}
+    for level in LEVELS:
+        admin = getattr(locator, level)
+        geometries.extend(admin.polygons)
+        levels[level] = {'relation_ids': admin.relation_ids}
+    wkb = shapely.to_wkb(np.array(geometries, dtype=object))
+    offsets = np.cumsum([0] + [len(x) for x in wkb]).astype('<i8')
+    header = {
+        'format': FORMAT_VERSION,
+        'sources': source_hashes(geojson_dir),
+        'stats': source_stats(geojson_dir),
+        'levels': levels,
+        'containment': [locator.city_provinces, locator.city_regions,
+                        locator.province_regions],
+        }
+    header_bytes = json.dumps(header).encode()
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', len(header_bytes), len(offsets)))
+        f.write(header_bytes)
+        f.write(offsets.tobytes())
+        for x in wkb:
+            f.write(x)
+    os.replace(path + '.tmp', path)
+    return header
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a compiled boundary file')
+        header_length, offset_count = struct.unpack('<II', f.read(8))
+        header = json.loads(f.read(header_length))
+    if header['format'] != FORMAT_VERSION:
+        raise ValueError(path + ' was compiled by an incompatible version')
+    return header, len(MAGIC) + 8 + header_length, offset_count
+
+def load_boundaries(path):
+    """Return a geog.PhilippinesLocator from a compiled boundary file."""
+    header, index_start, offset_count = read_header(path)
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = np.frombuffer(mm, dtype='<i8', count=offset_count, offset=index_start)
+        blob_start = index_start + offsets.nbytes
+        geometries = shapely.from_wkb(
+            [mm[blob_start + a:blob_start + b] for a, b in zip(offsets[:-1], offsets[1:])])
+        del offsets
+        mm.close()
+    admin = {}
+    position = 1
+    for level in LEVELS:
+        relation_ids = header['levels'][level]['relation_ids']
+        admin[level] = geog.AdminLocator(
+            relation_ids, geometries[position:position + len(relation_ids)])
+        position += len(relation_ids)
+    return geog.PhilippinesLocator(
+        geometries[0], admin['regions'], admin['provinces'], admin['cities'],
+        containment=tuple(header['containment']))
+
+def is_current(header, geojson_dir='GeoJSON'):
+    """
+    Return whether a compiled header matches the GeoJSON files. Files
+    with unchanged size and mtime are not re-hashed; a missing source
+    directory counts as current.
+    """
+    stats = source_stats(geojson_dir)
+    if stats is None or stats == header['stats']:
+        return True
+    return source_hashes(geojson_dir) == header['sources']
+
+def load_locator(geojson_dir='GeoJSON', path=None):
+    """
+    Return a locator from the compiled boundary file if it is current,
+    otherwise from the GeoJSON files.
+    """
+    path = path or compiled_path(geojson_dir)
+    if os.path.exists(path):
+        try:
+            header = read_header(path)[0]
+        except ValueError as e:
+            print(str(e) + ", loading GeoJSON. Run --compile-boundaries to refresh it")
+        else:
+            if is_current(header, geojson_dir):
+                return load_boundaries(path)
+            print("compiled boundaries in " + geojson_dir + " are out of date, loading GeoJSON. Run --compile-boundaries to refresh them")
+    return geog.PhilippinesLocator.from_files(geojson_dir)
+
+def load_versioned_locator(path=SETS_PATH, wrap=None):
+    """
+    Return the locator of the only boundary set, or a
+    geog.VersionedLocator over all of them. wrap(locator, geojson_dir)
+    may put a grid or cache in front of each set's locator.
+    """
+    locators = []
+    sets = boundary_sets(path)
+    for valid_from, geojson_dir in sets:
+        locator = load_locator(geojson_dir)
+        if wrap is not None:
+            locator = wrap(locator, geojson_dir)
+        locators.append(locator)
+    if len(sets) == 1:
+        return locators[0]
+    return geog.VersionedLocator([x[0] for x in sets], locators)
+
+def build_grid(geojson_dir='GeoJSON', path=None, cell_size=0.01):
+    """Build the admin-area grid and save it as NumPy arrays."""
+    path = path or grid_path(geojson_dir)
+    grid_locator = geog.GridLocator.build(load_locator(geojson_dir), cell_size)
+    triples = np.array([['' if x is None else x for x in triple]
+                        for triple in grid_locator.triples], dtype=str).reshape(-1, 3)
+    header = {'sources': source_hashes(geojson_dir), 'stats': source_stats(geojson_dir)}
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, grid=grid_locator.grid, triples=triples,
+                 origin=np.array([grid_locator.min_lon, grid_locator.min_lat, cell_size]),
+                 header=np.array(json.dumps(header)))
+    os.replace(path + '.tmp', path)
+    return grid_locator
+
+def load_grid(locator, geojson_dir='GeoJSON', path=None):
+    """
+    Return a geog.GridLocator over locator from the saved grid, or None
+    if there is no grid or it is out of date with the GeoJSON files.
+    """
+    path = path or grid_path(geojson_dir)
+    if not os.path.exists(path):
+        print("no admin-area grid at " + path + ". Run --build-grid to create it")
+        return None
+    with np.load(path) as arrays:
+        header = json.loads(str(arrays['header']))
+        if not is_current(header, geojson_dir):
+            print("admin-area grid is out of date. Run --build-grid to refresh it")
+            return None
+        triples = [tuple(x or None for x in triple) for triple in arrays['triples'].tolist()]
+        min_lon, min_lat, cell_size = arrays['origin'].tolist()
+        return geog.GridLocator(locator, arrays['grid'], triples,
+                                min_lon, min_lat, cell_size)
@@ -9,7 +9,11 @@ from OpenStreetmap into a postgres database for querying.
 from __future__ import print_function
 import sys
 import argparse
+import functools
 import gzip
+import io
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 import psycopg2
@@ -17,33 +21,104 @@ import psycopg2.extras
 import queries
 import requests
 import yaml
-from lxml import etree
 import geog
-from shapely.geometry import shape, Point
-import json
-import bz2
-from bs4 import BeautifulSoup
-import lxml
-import re
-from datetime import datetime, timedelta
-
-try:
-    from bz2file import BZ2File
-    bz2Support = True
-except ImportError:
-    bz2Support = False
+import boundaries
+import copyloader
+import indexes
+import inputs
+import parallel
+import partitions
+import postgis
+import metrics
+from metrics import Metrics
+import scanner
+import regeolocate
+import replcache
+import rollups
+import sequences
+import numpy as np
 
 BASE_REPL_URL = "https://planet.openstreetmap.org/replication/changesets/"
+GEOLOCATE_BATCH_SIZE = 20000
 
 class ChangesetMD():
-    def __init__(self, createGeometry):
+    def __init__(self, createGeometry, *, useCopy=False, replicationUrl=BASE_REPL_URL, prefetch=4, cache=None,
+                 geocacheCells=0, locatorBackend='exact', partitioned=False, connect=None, metrics=None):
+        """
+        connect() returns a new database connection, for work on
+        connections of its own such as the postgis locator. metrics
+        defaults to a metrics.Metrics that reports nowhere.
+        """
         self.createGeometry = createGeometry
+        self.partitioned = partitioned
+        self.partitions = None
+        self.rollups = False
+        self.schemaChecked = False
+        self.locatorBackend = locatorBackend
+        self.geocacheCells = geocacheCells
+        self.cache = cache
+        self.useCopy = useCopy
+        self.replicationUrl = replicationUrl if replicationUrl.endswith('/') else replicationUrl + '/'
+        self.prefetch = max(1, prefetch)
+        self.locator = None
+        self.connect = connect
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.prefetch)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def getLocator(self):
+        """
+        Return the boundary model, loading it on first use. It is shared
+        by every parse on this object, including each diff of a
+        replication catch-up.
+        """
+        if self.locator is None:
+            if self.locatorBackend == 'postgis':
+                if self.connect is None:
+                    raise ValueError('the postgis locator needs a connect function')
+                # Located in the database over connections from self.connect
+                self.locator = postgis.load_locator(self.connect)
+            else:
+                self.locator = boundaries.load_versioned_locator(wrap=self.wrapLocator)
+        return self.locator
+
+    def wrapLocator(self, locator, geojson_dir):
+        """Put the configured grid and cache in front of one boundary set."""
+        if self.locatorBackend == 'grid':
+            locator = boundaries.load_grid(locator, geojson_dir) or locator
+        if self.geocacheCells > 0:
+            locator = geog.CachedLocator(locator, max_cells=self.geocacheCells)
+        return locator
+
+    def reloadBoundaries(self):
+        """Reload the boundary model after the boundary files change."""
+        self.locator = None
+        geog.load_layers.cache_clear()
+        return self.getLocator()
+
+    def referenceDirs(self):
+        """Return the boundary set directories, newest first."""
+        return [geojson_dir for valid_from, geojson_dir in reversed(boundaries.boundary_sets())]
+
+    def rebuildReference(self, connection):
+        """Refresh the reference tables from the current boundary files."""
+        cursor = connection.cursor()
+        counts = geog.rebuild_reference_tables(cursor, self.referenceDirs())
+        connection.commit()
+        cursor.close()
+        print('rebuilt reference tables: ' + ', '.join(
+            '{} {:,}'.format(table, n) for table, n in counts.items()))
 
     def truncateTables(self, connection):
         print('truncating tables')
         cursor = connection.cursor()
         cursor.execute("TRUNCATE TABLE osm_changeset_comment CASCADE;")
         cursor.execute("TRUNCATE TABLE osm_changeset CASCADE;")
+        # The rollups have no foreign key for CASCADE to follow
+        if rollups.rollup_exists(cursor):
+            cursor.execute("TRUNCATE TABLE osm_changeset_daily_user, osm_changeset_daily_editor;")
         cursor.execute(queries.dropIndexes)
         cursor.execute("UPDATE osm_changeset_state set last_sequence = -1, last_timestamp = null, update_in_progress = 0")
         connection.commit()
@@ -51,13 +126,40 @@ class ChangesetMD():
     def createTables(self, connection):
         print('creating tables')
         cursor = connection.cursor()
-        cursor.execute(queries.createChangesetTable)
-        geog.geog_reference_tables(cursor)
+        if self.partitioned:
+            cursor.execute(queries.createPartitionedChangesetTable)
+        else:
+            cursor.execute(queries.createChangesetTable)
+        cursor.execute(queries.createRollupTables)
+        geog.geog_reference_tables(cursor, self.referenceDirs())
         cursor.execute(queries.initStateTable)
         if self.createGeometry:
-            cursor.execute(queries.createGeometryColumn)
+            if self.partitioned:
+                cursor.execute(queries.createPartitionedGeometryColumn)
+            else:
+                cursor.execute(queries.createGeometryColumn)
         connection.commit()
 
+    def checkSchema(self, connection):
+        """
+        Find out once per run whether the database is partitioned and
+        has rollup tables.
+        """
+        if not self.schemaChecked:
+            self.partitions = partitions.PartitionManager.from_connection(connection)
+            cursor = connection.cursor()
+            self.rollups = rollups.rollup_exists(cursor)
+            cursor.close()
+            self.schemaChecked = True
+
+    def getPartitions(self, connection):
+        """
+        Return the partitions.PartitionManager of the database, or None
+        if osm_changeset is not partitioned.
+        """
+        self.checkSchema(connection)
+        return self.partitions
+
     def insertNewBatch(self, connection, data_arr):
         cursor = connection.cursor()
         if self.createGeometry:
@@ -81,184 +183,313 @@ class ChangesetMD():
         psycopg2.extras.execute_batch(cursor, sql, comment_arr)
         cursor.close()
 
-    def deleteExisting(self, connection, id):
+    def flushBatch(self, connection, changesets, comments, doReplication):
+        """
+        Load a batch of changesets and comments. Replication and
+        incremental batches are upserted. With useCopy, initial
+        loads stream through COPY and commit after every batch instead of
+        holding one transaction open for the whole dump. In a
+        partitioned database, missing monthly partitions are created
+        first. Rollup tables are updated in the same transaction.
+        """
+        with self.metrics.timer('flush'):
+            partitionManager = self.getPartitions(connection)
+            if partitionManager is not None:
+                cursor = connection.cursor()
+                partitionManager.ensure_batch(cursor, changesets, comments)
+                cursor.close()
+            if doReplication:
+                self.upsertBatch(connection, changesets, comments)
+            elif self.useCopy:
+                cursor = connection.cursor()
+                copyloader.copy_changesets(cursor, changesets, self.createGeometry)
+                copyloader.copy_comments(cursor, comments)
+                self.updateRollups(cursor, changesets)
+                cursor.close()
+            else:
+                self.insertNewBatch(connection, changesets)
+                self.insertNewBatchComment(connection, comments)
+                cursor = connection.cursor()
+                self.updateRollups(cursor, changesets)
+                cursor.close()
+        if self.useCopy and not doReplication:
+            self.commit(connection)
+        self.metrics.count('changesets_loaded', len(changesets))
+        self.metrics.count('comments_loaded', len(comments))
+
+    def commit(self, connection):
+        with self.metrics.timer('commit'):
+            connection.commit()
+
+    def updateRollups(self, cursor, changesets, replaced=()):
+        """
+        Add a batch of changeset rows to the rollup tables, less the
+        stored versions of the changesets they replaced.
+        """
+        if not self.rollups:
+            return
+        delta = rollups.RollupDelta()
+        delta.add(replaced, -1)
+        delta.add_rows(changesets)
+        delta.apply(cursor)
+
+    def upsertBatch(self, connection, changesets, comments):
+        """
+        Replace a replication batch with set-based statements: one
+        INSERT ... ON CONFLICT on osm_changeset_pkey for the changesets,
+        and one DELETE plus INSERT for their comments. Stored versions
+        are read first so rollups can be updated by delta.
+        """
+        if not changesets:
+            return
+        # A changeset can only be updated once per statement; keep the
+        # last version of any changeset that appears twice.
+        latest = {}
+        for row in changesets:
+            latest[row[0]] = row
+        changesets = list(latest.values())
+        self.checkSchema(connection)
         cursor = connection.cursor()
+        replaced = rollups.stored_changesets(cursor, latest) if self.rollups else []
+        columns = list(copyloader.CHANGESET_COLUMNS)
+        template = '(' + ','.join(['%s'] * len(columns))
+        if self.createGeometry:
+            columns.append('geom')
+            template += ',ST_SetSRID(ST_MakeEnvelope(%s,%s,%s,%s), 4326)'
+        template += ')'
+        # Partitioned tables have the primary key (id, created_at)
+        key = ['id', 'created_at'] if self.partitions is not None else ['id']
+        updates = ', '.join(f'{x} = EXCLUDED.{x}' for x in columns if x not in key)
+        sql = f'''INSERT into osm_changeset ({', '.join(columns)})
+                  values %s
+                  ON CONFLICT ({', '.join(key)}) DO UPDATE SET {updates}'''
+        psycopg2.extras.execute_values(cursor, sql, changesets, template=template, page_size=len(changesets) or 1)
         cursor.execute('''DELETE FROM osm_changeset_comment
-                          WHERE comment_changeset_id = %s''', (id,))
-        cursor.execute('''DELETE FROM osm_changeset
-                          WHERE id = %s''', (id,))
+                          WHERE comment_changeset_id = ANY(%s)''', ([int(x) for x in latest],))
+        sql = '''INSERT into osm_changeset_comment
+                    (comment_changeset_id, comment_user_id, comment_user_name, comment_date, comment_text)
+                    values %s'''
+        psycopg2.extras.execute_values(cursor, sql, comments, page_size=len(comments) or 1)
+        self.updateRollups(cursor, changesets, replaced)
+        cursor.close()
 
-    def parseFile(self, connection, changesetFile, doReplication):
-        parsedCount = 0
+    def changesetRow(self, attrib, centroid_coordinates, city_id, province_id, region_id, tags):
+        row = (attrib['id'], attrib.get('uid', None),   attrib['created_at'], attrib.get('min_lat', None),
+                attrib.get('max_lat', None), attrib.get('min_lon', None),  attrib.get('max_lon', None), centroid_coordinates[0], centroid_coordinates[1], attrib.get('closed_at', None),
+                attrib.get('open', None), attrib.get('num_changes', None), attrib.get('user', None), city_id, province_id, region_id, tags)
+        if self.createGeometry:
+            row += (attrib.get('min_lon', None), attrib.get('min_lat', None),
+                    attrib.get('max_lon', None), attrib.get('max_lat', None))
+        return row
+
+    def geolocateBatch(self, locator, attribs):
+        """
+        Geolocate a batch of changeset attribute dicts in one vectorized
+        pass. Returns (index, centroid, city_id, province_id, region_id)
+        tuples for the changesets in the Philippines.
+        """
+        lons, lats = geog.calculate_centroids(
+            np.array([a['min_lon'] for a in attribs], dtype=float),
+            np.array([a['max_lon'] for a in attribs], dtype=float),
+            np.array([a['min_lat'] for a in attribs], dtype=float),
+            np.array([a['max_lat'] for a in attribs], dtype=float)
+            )
+        with self.metrics.timer('national'):
+            idx = np.flatnonzero(locator.contains_many(lons, lats))
+        with self.metrics.timer('locate'):
+            if isinstance(locator, (geog.VersionedLocator, postgis.PostgisLocator)):
+                # Located with the boundaries in effect when each was opened
+                cities, provinces, regions = locator.locate_many(
+                    lons[idx], lats[idx], [attribs[i]['created_at'] for i in idx])
+            else:
+                cities, provinces, regions = locator.locate_many(lons[idx], lats[idx])
+        return [(int(i), (float(lons[i]), float(lats[i])),
+                 geog.relation_number(city),
+                 geog.relation_number(province),
+                 geog.relation_number(region))
+                for i, city, province, region
+                in zip(idx, cities, provinces, regions)]
+
+    def geolocateRecords(self, locator, records, changesets, comments):
+        """
+        Geolocate (attrib, tags, comments) records and append rows for
+        the changesets in the Philippines. Returns the number found.
+        """
+        located = self.geolocateBatch(locator, [attrib for attrib, tags, c in records])
+        for i, centroid, city_id, province_id, region_id in located:
+            attrib, tags, recordComments = records[i]
+            comments.extend(recordComments)
+            changesets.append(self.changesetRow(
+                attrib, centroid, city_id, province_id, region_id, tags))
+        return len(located)
+
+    def loadedWatermark(self, connection):
+        """
+        Return a scanner.Watermark of the changesets already loaded, or
+        None if osm_changeset is empty.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT max(id), max(closed_at) FROM osm_changeset')
+        maxId, maxClosedAt = cursor.fetchone()
+        cursor.close()
+        if maxId is None:
+            return None
+        print("loaded up to changeset {}, closed {}".format(maxId, maxClosedAt))
+        return scanner.Watermark(maxId, maxClosedAt)
+
+    def parseFile(self, connection, changesetFile, doReplication, skip=None):
         PH_parsedCount = 0
         startTime = datetime.now()
-        cursor = connection.cursor()
-        context = etree.iterparse(changesetFile)
-        action, root = next(context)
         changesets = []
         comments = []
-        attribs_used = [
-            'id', 'uid', 'open', 'created_at', 'closed_at', 'min_lon', 'max_lon',
-            'min_lat', 'max_lat'
-            ]
-        
-        with open('GeoJSON/l2_national.geojson') as f:
-            ph = json.load(f)
-        ph_polygon = shape(ph['features'][0]['geometry'])
-
-        with open('GeoJSON/l3_regions.geojson') as f:
-            ph_r = json.load(f)
-
-        with open('GeoJSON/l4_provinces.geojson') as f:
-            ph_p = json.load(f)
-
-        with open('GeoJSON/l6_cities_municipalities.geojson') as f:
-            ph_cm = json.load(f)
+        records = []
         
-        for action, elem in context:
-            if any(x not in elem.attrib for x in attribs_used):
-                continue
-            if (elem.tag != 'changeset') or (elem.attrib['open'] != 'false'):
-                continue
-
-            parsedCount += 1
-            
-            centroid_coordinates = geog.calculate_centroid(
-                                    elem.attrib['min_lon'],
-                                    elem.attrib['max_lon'],
-                                    elem.attrib['min_lat'],
-                                    elem.attrib['max_lat']
-                                    )
-            centroid = Point(centroid_coordinates)
-            if geog.check_if_in_philippines(ph_polygon, centroid) == False:
-                continue
-            
-            PH_parsedCount += 1
-            
-            city = geog.locate_in_philippines(ph_cm, centroid)
-            province = geog.locate_in_philippines(ph_p, centroid)
-            region = geog.locate_in_philippines(ph_r, centroid)
-            
-            if city:
-                city_id = city[9:]
-            else:
-                city_id = city
-            
-            if province:
-                province_id = province[9:]
-            else:
-                province_id = province
-                
-            if region:
-                region_id = region[9:]
-            else:
-                region_is = region
-
-            tags = {}
-            for tag in elem.iterchildren(tag='tag'):
-                tags[tag.attrib['k']] = tag.attrib['v']
-                
-            for discussion in elem.iterchildren(tag='discussion'):
-                for commentElement in discussion.iterchildren(tag='comment'):
-                    for text in commentElement.iterchildren(tag='text'):
-                       text = text.text
-                    comment = (elem.attrib['id'], commentElement.attrib.get('uid'),  commentElement.attrib.get('user'), commentElement.attrib.get('date'), text)
-                    comments.append(comment)
-
-            if(doReplication):
-                self.deleteExisting(connection, elem.attrib['id'])
-
-            if self.createGeometry:
-                changesets.append((elem.attrib['id'], elem.attrib.get('uid', None),   elem.attrib['created_at'], elem.attrib.get('min_lat', None),
-                                elem.attrib.get('max_lat', None), elem.attrib.get('min_lon', None),  elem.attrib.get('max_lon', None), centroid_coordinates[0], centroid_coordinates[1], elem.attrib.get('closed_at', None),
-                                     elem.attrib.get('open', None), elem.attrib.get('num_changes', None), elem.attrib.get('user', None), city_id, province_id, region_id, tags,elem.attrib.get('min_lon', None), elem.attrib.get('min_lat', None),
-                                    elem.attrib.get('max_lon', None), elem.attrib.get('max_lat', None)))
-            else:
-                changesets.append((elem.attrib['id'], elem.attrib.get('uid', None),   elem.attrib['created_at'], elem.attrib.get('min_lat', None),
-                                elem.attrib.get('max_lat', None), elem.attrib.get('min_lon', None),  elem.attrib.get('max_lon', None), centroid_coordinates[0], centroid_coordinates[1], elem.attrib.get('closed_at', None),
-                                     elem.attrib.get('open', None), elem.attrib.get('num_changes', None), elem.attrib.get('user', None), city_id, province_id, region_id, tags))
-
-            if((PH_parsedCount % 10000) == 0):
-                self.insertNewBatch(connection, changesets)
-                self.insertNewBatchComment(connection, comments )
+        locator = self.getLocator()
+        national = locator.national
+        national.reset()
+        caches = [x for x in getattr(locator, 'locators', [locator]) if isinstance(x, geog.CachedLocator)]
+        for cache in caches:
+            cache.reset_stats()
+
+        # Changesets outside the national envelope are rejected from
+        # their start tag; only the rest are fully parsed.
+        changesetScanner = scanner.ChangesetScanner(changesetFile, national.envelope_contains, skip)
+        for record in changesetScanner:
+            records.append(record)
+            if len(records) >= GEOLOCATE_BATCH_SIZE:
+                PH_parsedCount += self.geolocateRecords(locator, records, changesets, comments)
+                records = []
+
+            if len(changesets) >= 10000:
+                self.flushBatch(connection, changesets, comments, doReplication)
                 changesets = []
                 comments = []
-                print(f"total PH changesets parsed: {PH_parsedCount}")
-                print("total parsed {}".format(('{:,}'.format(parsedCount))))
-                print("cumulative rate: {}/sec".format('{:,.0f}'.format(parsedCount/timedelta.total_seconds(datetime.now() - startTime))))
-
-            #clear everything we don't need from memory to avoid leaking
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
+                self.printProgress(PH_parsedCount, changesetScanner.parsedCount, startTime)
         # Update whatever is left, then commit
-        self.insertNewBatch(connection, changesets)
-        self.insertNewBatchComment(connection, comments)
-        connection.commit()
+        if records:
+            PH_parsedCount += self.geolocateRecords(locator, records, changesets, comments)
+        self.flushBatch(connection, changesets, comments, doReplication)
+        self.commit(connection)
+        self.printSummary(changesetScanner.parsedCount, national.rejected)
+        self.metrics.record_scan(changesetScanner, national.rejected)
+        self.metrics.count('changesets_located', PH_parsedCount)
+        if skip is not None:
+            print("skipped {:,} changesets already loaded".format(changesetScanner.skippedCount))
+        for cache in caches:
+            print("geolocation cache: {hits:,} hits, {misses:,} misses, {mixed:,} mixed, hit ratio {hit_ratio:.1%}".format(**cache.stats()))
+
+    def parseFileParallel(self, connection, fileName, workers, decompressWorkers=1, skip=None):
+        """
+        Parse a changeset dump with a reader process, a pool of
+        geolocation processes and this process loading the database,
+        connected by bounded queues. Rows are loaded in file order, so
+        the result is identical to parseFile. With skip, rows are
+        upserted as in an incremental load.
+        """
+        upsert = skip is not None
+        parsedCount = 0
+        PH_parsedCount = 0
+        startTime = datetime.now()
+        changesets = []
+        comments = []
+        rejected = {'envelope': 0, 'grid': 0, 'polygon': 0}
+
+        for chunk in parallel.geolocatedChunks(self, fileName, workers, GEOLOCATE_BATCH_SIZE, decompressWorkers, skip):
+            chunkRows, chunkComments, chunkParsed, chunkRejected, chunkSeconds = chunk
+            self.metrics.merge_seconds(chunkSeconds)
+            parsedCount += chunkParsed
+            PH_parsedCount += len(chunkRows)
+            changesets.extend(chunkRows)
+            comments.extend(chunkComments)
+            for tier in rejected:
+                rejected[tier] += chunkRejected[tier]
+
+            if len(changesets) >= 10000:
+                self.flushBatch(connection, changesets, comments, upsert)
+                changesets = []
+                comments = []
+                self.printProgress(PH_parsedCount, parsedCount, startTime)
+        self.flushBatch(connection, changesets, comments, upsert)
+        self.commit(connection)
+        self.printSummary(parsedCount, rejected)
+        self.metrics.count('changesets_parsed', parsedCount)
+        self.metrics.count('changesets_located', PH_parsedCount)
+        for tier, n in rejected.items():
+            self.metrics.count('rejected_' + tier, n)
+
+    def printProgress(self, PH_parsedCount, parsedCount, startTime):
+        print(f"total PH changesets parsed: {PH_parsedCount}")
+        print("total parsed {}".format(('{:,}'.format(parsedCount))))
+        print("cumulative rate: {}/sec".format('{:,.0f}'.format(parsedCount/timedelta.total_seconds(datetime.now() - startTime))))
+
+    def printSummary(self, parsedCount, rejected):
         print("parsing complete")
         print("parsed {:,}".format(parsedCount))
+        print("rejected by envelope {envelope:,}, grid {grid:,}, polygon {polygon:,}".format(**rejected))
 
-    def fetchReplicationFile(self, sequenceNumber):
+    def replicationFileUrl(self, sequenceNumber):
         sequenceNumber = str(sequenceNumber).zfill(9)
         topdir = str(sequenceNumber)[:3]
         subdir = str(sequenceNumber)[3:6]
         fileNumber = str(sequenceNumber)[-3:]
-        fileUrl = BASE_REPL_URL + topdir + '/' + subdir + '/' + fileNumber + '.osm.gz'
-        print("opening replication file at " + fileUrl)
-        replicationFile = requests.get(fileUrl, stream=True)
-        replicationData = replicationFile.raw
-        f = gzip.GzipFile(fileobj=replicationData)
+        return self.replicationUrl + topdir + '/' + subdir + '/' + fileNumber + '.osm.gz'
+
+    def downloadReplicationFile(self, sequenceNumber):
+        """
+        Return the compressed contents of a replication file, from the
+        local cache if it holds a verified copy.
+        """
+        if self.cache is not None:
+            replicationData = self.cache.get(sequenceNumber)
+            if replicationData is not None:
+                return replicationData
+        fileUrl = self.replicationFileUrl(sequenceNumber)
+        if not fileUrl.startswith(('http://', 'https://')):
+            with open(fileUrl, 'rb') as f:
+                return f.read()
+        print("downloading replication file at " + fileUrl)
+        replicationFile = self.session.get(fileUrl)
+        replicationFile.raise_for_status()
+        if self.cache is not None:
+            self.cache.put(sequenceNumber, replicationFile.content)
+        return replicationFile.content
+
+    def fetchReplicationFile(self, sequenceNumber):
+        replicationData = self.downloadReplicationFile(sequenceNumber)
+        f = gzip.GzipFile(fileobj=io.BytesIO(replicationData))
         return f
+
+    def prefetchReplicationFiles(self, firstSequence, lastSequence):
+        """
+        Yield (sequence, file) for each replication file from
+        firstSequence to lastSequence in order, while up to
+        self.prefetch later files download on a thread pool.
+        """
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            pending = collections.deque()
+            nextSequence = firstSequence
+            while nextSequence <= lastSequence and len(pending) < self.prefetch:
+                pending.append((nextSequence, executor.submit(self.fetchReplicationFile, nextSequence)))
+                nextSequence += 1
+            while pending:
+                sequence, download = pending.popleft()
+                replicationFile = download.result()
+                if nextSequence <= lastSequence:
+                    pending.append((nextSequence, executor.submit(self.fetchReplicationFile, nextSequence)))
+                    nextSequence += 1
+                yield sequence, replicationFile
     
-    def set_initial_sequence(self, connection, changesetFile):
+    def set_initial_sequence(self, connection, changesetFile=None, timestamp=None):
         """
         Set osm_changeset_state to the last sequence according
-        to the changesetFile.
+        to the changesetFile, or to a given timestamp.
         """
-        ts_pattern = re.compile(
-            r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}'
-        )
-        ts_format = '%Y-%m-%d %H:%M'
-        last_ts_format = '%Y-%m-%dT%H:%M:%SZ'
-        name_pattern = re.compile(r'[0-9]{3}')
-        
-        changesets = bz2.BZ2File(changesetFile)
-        peek_file = changesets.peek()
-        peek_file_bs4 = BeautifulSoup(peek_file, 'xml')
-        tag = peek_file_bs4.osm
-        last_time = tag['timestamp']
-        last_ts = datetime.strptime(last_time, last_ts_format)
-        
-        repl_url = BASE_REPL_URL
-        sequence = ''
-        subdirs = 0
-        
-        while subdirs!=3:
-            result = requests.get(repl_url)
-            repl_site = BeautifulSoup(result.text, 'html.parser')
-            
-            a_tags = repl_site.find_all(text=name_pattern)
-            
-            ts_dict = {}
-            for tag in a_tags:
-                ts_text = tag.parent.next_sibling.strip()
-                if ts_text:
-                    ts = ts_pattern.match(ts_text).group(0)
-                    ts_dict[datetime.strptime(ts, ts_format)] = tag
-            
-            ts_deltas_dict = {
-                ts_dict[key] : key - last_ts
-                for key in ts_dict.keys()
-                if key - last_ts >= timedelta(0)
-            }
-            
-            nextdir = min(ts_deltas_dict.keys())
-            sequence += nextdir[:3]
-            repl_url = repl_url + nextdir
-            
-            subdirs += 1
-        
-        last_sequence = sequence.lstrip('0')
+        if timestamp is None:
+            timestamp = sequences.dump_timestamp(changesetFile)
+        finder = sequences.SequenceFinder(
+            sequences.state_backend(self.replicationUrl, self.session))
+        last_sequence = finder.find(timestamp)
+        print("initial sequence for {}: {}".format(timestamp, last_sequence))
         cursor = connection.cursor()
         query = "update osm_changeset_state set last_sequence = %s;"
         cursor.execute(query, (last_sequence,))
@@ -290,12 +521,15 @@ class ChangesetMD():
         cursor.execute('update osm_changeset_state set update_in_progress = 1')
         connection.commit()
         print("latest sequence from the database: " + str(lastDbSequence))
+        if timestamp is not None:
+            self.metrics.gauge('replication_lag_seconds', metrics.lag_seconds(timestamp))
 
         #No matter what happens after this point, execution needs to reach the update statement
         #at the end of this method to unlock the database or an error will forever leave it locked
         returnStatus = 0
         try:
-            serverState = yaml.load(requests.get(BASE_REPL_URL + "state.yaml").text)
+            serverState = yaml.safe_load(
+                sequences.state_backend(self.replicationUrl, self.session).read("state.yaml"))
             lastServerSequence = serverState['sequence']
             print("got sequence")
             lastServerTimestamp = serverState['last_run']
@@ -307,14 +541,19 @@ class ChangesetMD():
         else:
             try:
                 print("latest sequence on OSM server: " + str(lastServerSequence))
+                self.metrics.gauge('replication_lag_sequences', max(0, lastServerSequence - lastDbSequence))
                 if(lastServerSequence > lastDbSequence):
                     print("server has new sequence. commencing replication")
-                    currentSequence = lastDbSequence + 1
-                    while(currentSequence <= lastServerSequence):
-                        self.parseFile(connection, self.fetchReplicationFile(currentSequence), True)
+                    # Later diffs download while the current one is applied,
+                    # but each is still committed strictly in order.
+                    replicationFiles = self.prefetchReplicationFiles(lastDbSequence + 1, lastServerSequence)
+                    for currentSequence, replicationFile in replicationFiles:
+                        self.parseFile(connection, replicationFile, True)
                         cursor.execute('update osm_changeset_state set last_sequence = %s', (currentSequence,))
-                        connection.commit()
-                        currentSequence += 1
+                        self.commit(connection)
+                        self.metrics.count('sequences_applied')
+                        self.metrics.gauge('replication_lag_sequences', lastServerSequence - currentSequence)
+                        self.metrics.report('sequence')
                     timestamp = lastServerTimestamp
                 print("finished with replication. Clearing status record")
             except Exception as e:
@@ -323,6 +562,11 @@ class ChangesetMD():
                 returnStatus = 2
         cursor.execute('update osm_changeset_state set update_in_progress = 0, last_timestamp = %s', (timestamp,))
         connection.commit()
+        if self.cache is not None:
+            self.cache.evict()
+        if timestamp is not None:
+            self.metrics.gauge('replication_lag_seconds', metrics.lag_seconds(timestamp))
+        self.metrics.report('replication')
         return returnStatus
 
 if __name__ == '__main__':
@@ -337,29 +581,146 @@ if __name__ == '__main__':
     argParser.add_argument('-P', '--port', action='store', dest='dbPort', default=None, help='Database port')
     argParser.add_argument('-u', '--user', action='store', dest='dbUser', default=None, help='Database username')
     argParser.add_argument('-p', '--password', action='store', dest='dbPass', default=None, help='Database password')
-    argParser.add_argument('-d', '--database', action='store', dest='dbName', help='Target database', required=True)
+    argParser.add_argument('-d', '--database', action='store', dest='dbName', help='Target database')
     argParser.add_argument('-f', '--file', action='store', dest='fileName', help='OSM changeset file to parse')
     argParser.add_argument('-r', '--replicate', action='store_true', dest='doReplication', default=False, help='Apply a replication file to an existing database')
     argParser.add_argument('-g', '--geometry', action='store_true', dest='createGeometry', default=False, help='Build geometry of changesets (requires postgis)')
     argParser.add_argument('-s', '--setinitial', action='store', dest='sequenceFile', default=None, help='OSM changeset file to find last sequence of')
+    argParser.add_argument('--settimestamp', action='store', dest='sequenceTimestamp', default=None, help='Set the last sequence to the one at this UTC time (YYYY-MM-DDTHH:MM:SSZ)')
+    argParser.add_argument('-i', '--incremental', action='store_true', dest='incremental', default=False, help='Only load changesets from the dump file that are newer than those already loaded')
+    argParser.add_argument('--rebuild-reference', action='store_true', dest='rebuildReference', default=False, help='Refresh the city, province and region reference tables from the GeoJSON files')
+    argParser.add_argument('--rebuild-rollups', action='store_true', dest='rebuildRollups', default=False, help='Create the daily rollup tables if needed and rebuild them from the changeset table')
+    argParser.add_argument('--regeolocate', action='store_true', dest='regeolocate', default=False, help='Reassign admin areas of loaded changesets after the boundary sets change, using -w processes')
+    argParser.add_argument('--since', action='store', dest='since', default=None, help='With --regeolocate, only changesets created from this UTC date (YYYY-MM-DD)')
+    argParser.add_argument('--until', action='store', dest='until', default=None, help='With --regeolocate, only changesets created before this UTC date (YYYY-MM-DD)')
+    argParser.add_argument('--previous-boundaries', action='store', dest='previousBoundaries', default=None, help='With --regeolocate, GeoJSON directory the changesets were located with, if not one of the boundary sets')
+    argParser.add_argument('--slice-days', action='store', dest='sliceDays', type=int, default=7, help='With --regeolocate, days of changesets per transaction (default 7)')
+    argParser.add_argument('--partitioned', action='store_true', dest='partitioned', default=False, help='With -c, partition the changeset and comment tables by month')
+    argParser.add_argument('--index-jobs', action='store', dest='indexJobs', type=int, default=2, help='Number of indexes to build at the same time after a load (default 2)')
+    argParser.add_argument('--maintenance-work-mem', action='store', dest='maintenanceWorkMem', default='512MB', help='maintenance_work_mem for each index build (default 512MB)')
+    argParser.add_argument('--parallel-maintenance-workers', action='store', dest='parallelMaintenanceWorkers', type=int, default=0, help='max_parallel_maintenance_workers for each index build (default 0)')
+    argParser.add_argument('--copy', action='store_true', dest='useCopy', default=False, help='Load dump files with COPY instead of INSERT, committing after every batch')
+    argParser.add_argument('--replication-url', action='store', dest='replicationUrl', default=BASE_REPL_URL, help='Base URL or local path of the changeset replication directory')
+    argParser.add_argument('--prefetch', action='store', dest='prefetch', type=int, default=4, help='Number of replication files to download ahead of the one being applied')
+    argParser.add_argument('--cache-dir', action='store', dest='cacheDir', default=None, help='Directory to keep downloaded replication files in')
+    argParser.add_argument('--cache-max-mb', action='store', dest='cacheMaxMb', type=float, default=None, help='Evict the oldest cached replication files above this size')
+    argParser.add_argument('--cache-max-days', action='store', dest='cacheMaxDays', type=float, default=None, help='Evict cached replication files older than this')
+    argParser.add_argument('--compile-boundaries', action='store_true', dest='compileBoundaries', default=False, help='Compile the GeoJSON boundaries of each boundary set into boundaries.bin for fast loading')
+    argParser.add_argument('--geocache', action='store', dest='geocacheCells', type=int, default=0, help='Cache admin-area lookups for up to this many ~100 m centroid cells')
+    argParser.add_argument('--locator', action='store', dest='locatorBackend', choices=['exact', 'grid', 'postgis'], default='exact', help='Admin-area lookup backend; postgis locates in the database')
+    argParser.add_argument('--load-postgis-boundaries', action='store_true', dest='loadPostgisBoundaries', default=False, help='Reload the boundary sets into the PostGIS boundary tables')
+    argParser.add_argument('--compare-postgis', action='store', dest='comparePostgis', type=int, default=None, help='Compare the PostGIS and Python locators on this many random points')
+    argParser.add_argument('--build-grid', action='store_true', dest='buildGrid', default=False, help='Build the admin-area grid of each boundary set at admin_grid.npz')
+    argParser.add_argument('--validate-grid', action='store', dest='validateGrid', type=int, default=None, help='Compare the grid and exact locators on this many random points')
+    argParser.add_argument('--decompress-workers', action='store', dest='decompressWorkers', type=int, default=1, help='Number of processes decompressing a .bz2 dump block by block')
+    argParser.add_argument('--metrics-log', action='store', dest='metricsLog', default=None, help='Append stage timings and counters as JSON lines to this file')
+    argParser.add_argument('--metrics-textfile', action='store', dest='metricsTextfile', default=None, help='Write metrics to this Prometheus textfile')
+    argParser.add_argument('--metrics-port', action='store', dest='metricsPort', type=int, default=None, help='Serve metrics on this local HTTP port while running')
+    argParser.add_argument('--profile', action='store', dest='profile', default=None, help='Profile parsing with cProfile, writing stats to this file')
+    argParser.add_argument('-w', '--workers', action='store', dest='workers', type=int, default=1, help='Number of geolocation processes for parsing a dump file')
 
     args = argParser.parse_args()
 
-    conn = psycopg2.connect(database=args.dbName, user=args.dbUser, password=args.dbPass, host=args.dbHost, port=args.dbPort)
-
-
-    md = ChangesetMD(args.createGeometry)
+    boundarySets = boundaries.boundary_sets()
+    if args.compileBoundaries:
+        for valid_from, geojson_dir in boundarySets:
+            print('compiling boundaries in ' + geojson_dir)
+            header = boundaries.compile_boundaries(geojson_dir)
+            print('wrote ' + boundaries.compiled_path(geojson_dir) + ' from ' + ', '.join(
+                '{} ({})'.format(name, digest[:12]) for name, digest in header['sources'].items()))
+
+    if args.buildGrid:
+        for valid_from, geojson_dir in boundarySets:
+            print('building admin-area grid for ' + geojson_dir)
+            boundaries.build_grid(geojson_dir)
+            print('wrote ' + boundaries.grid_path(geojson_dir))
+
+    if args.validateGrid is not None:
+        for valid_from, geojson_dir in boundarySets:
+            exact = boundaries.load_locator(geojson_dir)
+            grid = boundaries.load_grid(exact, geojson_dir)
+            if grid is None:
+                sys.exit(1)
+            compared, mismatches = geog.validate_grid(grid, exact, args.validateGrid)
+            for lon, lat, expected, found in mismatches[:20]:
+                print('mismatch at {:.7f},{:.7f}: exact {} grid {}'.format(lon, lat, expected, found))
+            print('{}: compared {:,} points, {:,} mismatches'.format(geojson_dir, compared, len(mismatches)))
+            if mismatches:
+                sys.exit(1)
+
+    if args.compileBoundaries or args.buildGrid or args.validateGrid is not None:
+        if args.dbName is None:
+            sys.exit(0)
+
+    if args.dbName is None:
+        argParser.error('the following arguments are required: -d/--database')
+
+    connectArgs = dict(database=args.dbName, user=args.dbUser, password=args.dbPass, host=args.dbHost, port=args.dbPort)
+    connect = functools.partial(psycopg2.connect, **connectArgs)
+    conn = connect()
+
+
+    cache = None
+    if args.cacheDir is not None:
+        cache = replcache.ReplicationCache(
+            args.cacheDir,
+            None if args.cacheMaxMb is None else int(args.cacheMaxMb * 1024 * 1024),
+            None if args.cacheMaxDays is None else args.cacheMaxDays * 86400)
+    md = ChangesetMD(args.createGeometry, useCopy=args.useCopy, replicationUrl=args.replicationUrl,
+                     prefetch=args.prefetch, cache=cache, geocacheCells=args.geocacheCells,
+                     locatorBackend=args.locatorBackend, partitioned=args.partitioned, connect=connect,
+                     metrics=metrics.Metrics(args.metricsLog, args.metricsTextfile))
+    if args.metricsPort is not None:
+        metrics.serve(md.metrics, args.metricsPort)
+    parallelLoad = args.fileName is not None and args.workers > 1 and not args.doReplication
+    parseFileParallel = md.parseFileParallel
+    if args.profile is not None:
+        # With -w, only this (loading) process is profiled, not the
+        # geolocation workers
+        if parallelLoad:
+            parseFileParallel = metrics.profiled(md.parseFileParallel, args.profile)
+        else:
+            md.parseFile = metrics.profiled(md.parseFile, args.profile)
     if args.truncateTables:
         md.truncateTables(conn)
 
     if args.createTables:
         md.createTables(conn)
 
+    if args.locatorBackend == 'postgis' or args.loadPostgisBoundaries or args.comparePostgis is not None:
+        postgis.ensure_boundaries(conn, reload=args.loadPostgisBoundaries)
+
+    if args.comparePostgis is not None:
+        compared, seconds, mismatches = postgis.compare(
+            postgis.load_locator(connect), boundaries.load_versioned_locator(), args.comparePostgis)
+        for lon, lat, date, expected, found in mismatches[:20]:
+            print('mismatch at {:.7f},{:.7f} {}: python {} postgis {}'.format(lon, lat, date or '', expected, found))
+        for backend in ('exact', 'postgis'):
+            print('{}: {:,} points in {:.2f}s, {:,.0f} points/s'.format(
+                backend, compared, seconds[backend], compared / seconds[backend] if seconds[backend] else 0))
+        print('compared {:,} points, {:,} mismatches'.format(compared, len(mismatches)))
+
     psycopg2.extras.register_hstore(conn)
     
     if not (args.sequenceFile is None):
         md.set_initial_sequence(conn, args.sequenceFile)
 
+    if not (args.sequenceTimestamp is None):
+        md.set_initial_sequence(conn, timestamp=datetime.strptime(args.sequenceTimestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+    if args.rebuildReference:
+        md.rebuildReference(conn)
+
+    if args.rebuildRollups:
+        rollups.rebuild_rollups(conn)
+
+    if args.regeolocate:
+        regeolocate.regeolocate(
+            connectArgs,
+            None if args.since is None else datetime.strptime(args.since, '%Y-%m-%d'),
+            None if args.until is None else datetime.strptime(args.until, '%Y-%m-%d'),
+            args.workers, args.sliceDays, args.previousBoundaries)
+
     if(args.doReplication):
         returnStatus = md.doReplication(conn)
         sys.exit(returnStatus)
@@ -369,37 +730,37 @@ if __name__ == '__main__':
             print('parsing changeset file with geometries')
         else:
             print('parsing changeset file')
-        changesetFile = None
-        if(args.doReplication):
-            changesetFile = gzip.open(args.fileName, 'rb')
+        skip = None
+        if args.incremental:
+            skip = md.loadedWatermark(conn)
+        # Incremental loads upsert, like replication
+        upsert = args.doReplication or skip is not None
+        if parallelLoad:
+            parseFileParallel(conn, args.fileName, args.workers, args.decompressWorkers, skip)
         else:
-            if(args.fileName[-4:] == '.bz2'):
-                if(bz2Support):
-                    changesetFile = BZ2File(args.fileName)
-                else:
-                    print('ERROR: bzip2 support not available. Unzip file first or install bz2file')
-                    sys.exit(1)
+            changesetFile = None
+            if(args.doReplication):
+                changesetFile = gzip.open(args.fileName, 'rb')
             else:
-                changesetFile = open(args.fileName, 'rb')
+                changesetFile = inputs.open_changeset_file(args.fileName, args.decompressWorkers)
 
-        if(changesetFile != None):
-            md.parseFile(conn, changesetFile, args.doReplication)
-        else:
-            print('ERROR: no changeset file opened. Something went wrong in processing args')
-            sys.exist(1)
-
-        if(not args.doReplication):
-            cursor = conn.cursor()
-            print('creating constraints')
-            cursor.execute(queries.createConstraints)
-            print('creating indexes')
-            cursor.execute(queries.createIndexes)
+            if(changesetFile != None):
+                md.parseFile(conn, changesetFile, upsert, skip)
+                if not args.doReplication:
+                    inputs.report_throughput(changesetFile)
+                changesetFile.close()
+            else:
+                print('ERROR: no changeset file opened. Something went wrong in processing args')
+                sys.exit(1)
+
+        if(not upsert):
+            conn.commit()
+            indexes.build_indexes(connect, args.createGeometry, args.indexJobs, args.maintenanceWorkMem, args.parallelMaintenanceWorkers,
+                                  md.getPartitions(conn) is not None)
             print('setting initial sequence')
             md.set_initial_sequence(conn, args.fileName)
-            if args.createGeometry:
-                cursor.execute(queries.createGeomIndex)
-            conn.commit()
 
+        md.metrics.report('load')
         conn.close()
 
     endTime = datetime.now()
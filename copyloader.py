@@ -0,0 +1,67 @@
+'''
+COPY-based bulk loading of changesets and comments. Rows are the same
+tuples passed to the INSERT path; hstore tags and changeset envelopes
+are encoded client-side into COPY text format.
+
+'''
+import io
+
+CHANGESET_COLUMNS = [
+    'id', 'user_id', 'created_at', 'min_lat', 'max_lat', 'min_lon', 'max_lon',
+    'centroid_lon', 'centroid_lat', 'closed_at', 'open', 'num_changes',
+    'user_name', 'city_id', 'province_id', 'region_id', 'tags'
+    ]
+COMMENT_COLUMNS = [
+    'comment_changeset_id', 'comment_user_id', 'comment_user_name',
+    'comment_date', 'comment_text'
+    ]
+
+def escape_copy(value):
+    """Escape a string for a COPY text format field."""
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def encode_hstore(tags):
+    """Return the hstore text representation of a dict of tags."""
+    def quote(x):
+        return '"' + x.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return ', '.join(quote(k) + '=>' + quote(v) for k, v in tags.items())
+
+def encode_envelope(min_lon, min_lat, max_lon, max_lat):
+    """
+    Return EWKT of a changeset bounding box, with the same vertex
+    order as ST_MakeEnvelope.
+    """
+    return ('SRID=4326;POLYGON(({0} {1},{0} {3},{2} {3},{2} {1},{0} {1}))'
+            .format(min_lon, min_lat, max_lon, max_lat))
+
+def encode_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, dict):
+        return escape_copy(encode_hstore(value))
+    return escape_copy(str(value))
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream rows into table through COPY ... FROM STDIN."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(encode_field(x) for x in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buffer)
+
+def copy_changesets(cursor, rows, createGeometry):
+    """
+    Copy changeset rows. In geometry mode the trailing envelope
+    coordinates of each row become the geom column.
+    """
+    columns = list(CHANGESET_COLUMNS)
+    if createGeometry:
+        columns.append('geom')
+        rows = [row[:-4] + (encode_envelope(*row[-4:]),) for row in rows]
+    copy_rows(cursor, 'osm_changeset', columns, rows)
+
+def copy_comments(cursor, rows):
+    copy_rows(cursor, 'osm_changeset_comment', COMMENT_COLUMNS, rows)
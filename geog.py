@@ -1,11 +1,17 @@
+import collections
+import csv
+import functools
 import json
-import pandas as pd
 import re
 import numpy as np
+import shapely
 from shapely.geometry import shape, Point
-from sqlalchemy import create_engine
+from shapely.strtree import STRtree
 import psycopg2.extras as extras
 
+GEOJSON_LAYERS = ['l2_national', 'l3_regions', 'l4_provinces',
+                  'l6_cities_municipalities']
+
 def calculate_centroid(min_lon, max_lon, min_lat, max_lat):
     """
     Return centroid point of changeset bounding box.
@@ -15,10 +21,23 @@ def calculate_centroid(min_lon, max_lon, min_lat, max_lat):
     centroid = (centroid_lon, centroid_lat)
     return(centroid)
 
+def calculate_centroids(min_lon, max_lon, min_lat, max_lat):
+    """
+    Return arrays of centroid longitudes and latitudes of
+    changeset bounding boxes given as NumPy arrays.
+    """
+    centroid_lon = (min_lon + max_lon) / 2
+    centroid_lat = (min_lat + max_lat) / 2
+    return(centroid_lon, centroid_lat)
+
 def check_if_in_philippines(ph_polygon, point):
     """Return boolean of whether point is in the Philippines"""
     return ph_polygon.contains(point)
 
+def check_if_in_philippines_many(ph_polygon, lons, lats):
+    """Return boolean array of whether points are in the Philippines"""
+    return shapely.contains_xy(ph_polygon, lons, lats)
+
 def locate_in_philippines(geojson_file, point):
     """
     Return relation ID of feature within a geojson file
@@ -29,169 +48,620 @@ def locate_in_philippines(geojson_file, point):
         if 'name' in x['properties'] and polygon.contains(point):
             return(x['properties']['@id'])
 
-def geog_reference_tables(cursor):
-    with open('GeoJSON/l6_cities_municipalities.geojson') as f:
-        ph_cm = json.load(f)
-    with open('GeoJSON/l4_provinces.geojson') as f:
-        ph_p = json.load(f)
-    with open('GeoJSON/l3_regions.geojson') as f:
-        ph_r = json.load(f)
-    provinces = pd.read_csv('geog_tables/provinces.csv', index_col=0)
-    
-    ### CITIES
-    
-    # Sort features by what identifying properties they have
-    with_wikidata = [x['properties']['wikidata']
-                    for x in ph_cm['features'] 
-                    if 'name' in x['properties']
-                    and 'wikidata' in x['properties']]
-    without_wikidata = [x
-                        for x in ph_cm['features'] 
-                        if 'name' in x['properties']
-                        and 'wikidata' not in x['properties']]
-    isin_pattern = re.compile(r'is_in:?\w*')
-    with_isin = [x['properties']
-                for x in ph_cm['features']
-                if 'name' in x['properties']
-                for y in x['properties']
-                if re.match(isin_pattern, y)]
-    without_wikidata_with_isin = [x
-                                for x in without_wikidata
-                                for y in x['properties']
-                                if re.match(isin_pattern, y)]
-    without_wikidata_without_isin = [x
-                                    for x in without_wikidata
-                                    if x not in without_wikidata_with_isin]
-    
-    # Create wikidata dataframe
-    wikidata = pd.read_csv('geog_tables/wikidataqueryoutput.csv')
-    wikidata['item'] = wikidata['item'].str[31:]
-    
-    # Create wikidata-relation dataframe
-    wd_rel_pairs = [[x['properties']['wikidata'], x['properties']['@id']]
-                    for x in ph_cm['features']
-                    if ('name' in x['properties'])
-                    and ('wikidata' in x['properties'])]
-    wd_rel_df = pd.DataFrame(wd_rel_pairs, columns=['wikidata', 'relation'])
-    
-    # Create geography reference dataframe
-    cm_df = pd.merge(wd_rel_df, wikidata,
-                                left_on='wikidata',
-                                right_on='item',
-                                how='inner')
-    cm_df = cm_df.drop('item', axis=1)
-    cm_df.columns = [
-        'wikidata_entry',
-        'relation_id',
-        'city_or_mun',
-        'province_or_region',
-        'type',
-        'income_class',
-        'population'
-        ]
-    
-    # Create relation-"is_in" property database for features
-    # for features without wikidata property
-    isin_rel = [[x['properties']['name'],
-                x['properties'][isin],
-                x['properties']['@id']]
-                for x in without_wikidata_with_isin
-                for isin in x['properties']
-                if re.match(isin_pattern, isin)]
-    isin_rel_df = pd.DataFrame(
-        isin_rel,
-        columns=['city_or_mun',
-            'province_or_region',
-            'relation']
-        )
-    isin_rel_wd = pd.merge(
-        wikidata,
-        isin_rel_df,
-        left_on=[
-            wikidata['itemLabel'].str.lower(),
-            wikidata['withinLabel'].str.lower()
-            ],
-        right_on=[
-            isin_rel_df['city_or_mun'].str.lower(),
-            isin_rel_df['province_or_region'].str.lower()
-            ],
-        how='inner'
-        )
-    isin_rel_wd = isin_rel_wd[
-        ['item', 'relation', 'city_or_mun',
-        'province_or_region', 'instanceofLabel',
-        'incomeclassLabel', 'population']
+def relation_number(relation):
+    """Strip the 'relation/' prefix from an Overpass feature ID."""
+    if relation:
+        return(relation[9:])
+    return(None)
+
+class AdminLocator():
+    """
+    Prepared geometries of the named features of one administrative
+    level, behind an STRtree bounding-box index. names are only needed
+    to build containment tables.
+    """
+    def __init__(self, relation_ids, polygons, names=()):
+        self.relation_ids = list(relation_ids)
+        self.names = list(names)
+        self.polygons = np.array(polygons, dtype=object)
+        shapely.prepare(self.polygons)
+        self.tree = STRtree(self.polygons)
+
+    @classmethod
+    def from_geojson(cls, geojson_file):
+        relation_ids = []
+        names = []
+        polygons = []
+        for x in geojson_file['features']:
+            if 'name' in x['properties']:
+                relation_ids.append(x['properties']['@id'])
+                names.append(x['properties']['name'])
+                polygons.append(shape(x['geometry']))
+        return(cls(relation_ids, polygons, names))
+
+    def locate(self, point):
+        """
+        Return relation ID of the feature containing a given point.
+        Candidates are tested in file order, so the result matches
+        locate_in_philippines.
+        """
+        for i in sorted(self.tree.query(point)):
+            if self.polygons[i].contains(point):
+                return(self.relation_ids[i])
+
+    def locate_many(self, lons, lats):
+        """
+        Return a list of relation IDs (None where nothing matches)
+        of the features containing each point, in one tree query.
+        """
+        result = [None] * len(lons)
+        if len(lons) == 0:
+            return(result)
+        points = shapely.points(lons, lats)
+        point_idx, polygon_idx = self.tree.query(points, predicate='within')
+        # Keep the first feature in file order for each point
+        order = np.lexsort((polygon_idx, point_idx))
+        point_idx = point_idx[order]
+        polygon_idx = polygon_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        for i, j in zip(point_idx[first], polygon_idx[first]):
+            result[i] = self.relation_ids[j]
+        return(result)
+
+    def relation_by_name(self, name):
+        """Return relation ID of the feature with a given name."""
+        lowered = [x.lower() for x in self.names]
+        if name.lower() in lowered:
+            return(self.relation_ids[lowered.index(name.lower())])
+
+def build_containment_table(children, parents, city_reference=None):
+    """
+    Return dict of child relation ID -> parent relation ID, using a
+    representative point of each child polygon. If given,
+    city_reference (child relation ID -> province_or_region name of
+    city_municipality_reference) names the parent of children whose
+    point falls outside every parent polygon.
+    """
+    reference_names = city_reference or {}
+    table = {}
+    for relation, polygon in zip(children.relation_ids, children.polygons):
+        parent = parents.locate(polygon.representative_point())
+        if parent is None and relation in reference_names:
+            parent = parents.relation_by_name(reference_names[relation])
+        table[relation] = parent
+    return(table)
+
+class NationalFilter():
+    """
+    Tiered rejection of points outside the Philippines. Tier one is
+    a pure-float envelope check, tier two a coarse grid of cells
+    known to be entirely inside or outside the national outline,
+    and only points in cells straddling the border reach the exact
+    polygon test. Rejections per tier are counted in self.rejected.
+    """
+    OUTSIDE = 0
+    INSIDE = 1
+    MIXED = 2
+
+    def __init__(self, ph_polygon, cell_size=0.1):
+        self.ph_polygon = ph_polygon
+        self.min_lon, self.min_lat, self.max_lon, self.max_lat = ph_polygon.bounds
+        self.cell_size = cell_size
+        self.n_lon = int(np.ceil((self.max_lon - self.min_lon) / cell_size))
+        self.n_lat = int(np.ceil((self.max_lat - self.min_lat) / cell_size))
+        lon_edges = self.min_lon + np.arange(self.n_lon) * cell_size
+        lat_edges = self.min_lat + np.arange(self.n_lat) * cell_size
+        cell_lons, cell_lats = np.meshgrid(lon_edges, lat_edges, indexing='ij')
+        cells = shapely.box(cell_lons, cell_lats,
+                            cell_lons + cell_size, cell_lats + cell_size)
+        # contains_properly keeps boundary points out of INSIDE cells,
+        # so the grid never disagrees with the exact test.
+        self.grid = np.where(
+            shapely.contains_properly(ph_polygon, cells), self.INSIDE,
+            np.where(shapely.intersects(ph_polygon, cells), self.MIXED,
+                    self.OUTSIDE)).astype(np.uint8)
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path='GeoJSON/l2_national.geojson'):
+        """Build the filter from the national GeoJSON file."""
+        with open(path) as f:
+            ph = json.load(f)
+        ph_polygon = shape(ph['features'][0]['geometry'])
+        shapely.prepare(ph_polygon)
+        return(cls(ph_polygon))
+
+    def reset(self):
+        """Zero the per-tier rejection counters."""
+        self.rejected = {'envelope': 0, 'grid': 0, 'polygon': 0}
+
+    def envelope_contains(self, min_lon, max_lon, min_lat, max_lat):
+        """
+        Return boolean of whether the centroid of a bounding box given
+        as raw attribute strings is inside the national envelope.
+        """
+        lon = (float(min_lon) + float(max_lon)) / 2
+        lat = (float(min_lat) + float(max_lat)) / 2
+        inside = (self.min_lon <= lon <= self.max_lon
+                  and self.min_lat <= lat <= self.max_lat)
+        if not inside:
+            self.rejected['envelope'] += 1
+        return inside
+
+    def contains_many(self, lons, lats):
+        """Return boolean array of whether points are in the Philippines"""
+        i = np.floor((lons - self.min_lon) / self.cell_size).astype(np.int64)
+        j = np.floor((lats - self.min_lat) / self.cell_size).astype(np.int64)
+        on_grid = (i >= 0) & (i < self.n_lon) & (j >= 0) & (j < self.n_lat)
+        state = np.full(len(lons), self.OUTSIDE, dtype=np.uint8)
+        state[on_grid] = self.grid[i[on_grid], j[on_grid]]
+        result = state == self.INSIDE
+        mixed = state == self.MIXED
+        self.rejected['grid'] += int(np.count_nonzero(state == self.OUTSIDE))
+        if mixed.any():
+            exact = check_if_in_philippines_many(
+                self.ph_polygon, lons[mixed], lats[mixed])
+            result[mixed] = exact
+            self.rejected['polygon'] += int(np.count_nonzero(~exact))
+        return result
+
+class PhilippinesLocator():
+    """
+    National outline plus city, province and region indexes.
+    Build once per run and reuse for every changeset.
+    """
+    def __init__(self, ph_polygon, regions, provinces, cities,
+                 city_reference=None, containment=None):
+        self.ph_polygon = ph_polygon
+        shapely.prepare(self.ph_polygon)
+        self.national = NationalFilter(self.ph_polygon)
+        self.regions = regions
+        self.provinces = provinces
+        self.cities = cities
+        # A city's province and region are fixed, so one city hit
+        # resolves all three levels.
+        if containment is None:
+            containment = (
+                build_containment_table(cities, provinces, city_reference),
+                build_containment_table(cities, regions, city_reference),
+                build_containment_table(provinces, regions)
+                )
+        self.city_provinces, self.city_regions, self.province_regions = containment
+
+    @classmethod
+    def from_geojson(cls, ph, ph_r, ph_p, ph_cm, city_reference=None):
+        return(cls(
+            shape(ph['features'][0]['geometry']),
+            AdminLocator.from_geojson(ph_r),
+            AdminLocator.from_geojson(ph_p),
+            AdminLocator.from_geojson(ph_cm),
+            city_reference=city_reference
+            ))
+
+    @classmethod
+    def from_files(cls, geojson_dir='GeoJSON', city_reference=None):
+        """
+        Load the national and admin-level GeoJSON files. city_reference
+        defaults to the city_municipality_reference rows of the files.
+        """
+        layers = load_layers(geojson_dir)
+        if city_reference is None:
+            city_reference = {'relation/' + row[1]: row[3]
+                              for row in city_reference_rows(layers[3]['features'], read_wikidata())}
+        return(cls.from_geojson(*layers, city_reference=city_reference))
+
+    def contains(self, point):
+        """Return boolean of whether point is in the Philippines"""
+        return check_if_in_philippines(self.ph_polygon, point)
+
+    def contains_many(self, lons, lats):
+        """Return boolean array of whether points are in the Philippines"""
+        return self.national.contains_many(lons, lats)
+
+    def locate(self, point):
+        """
+        Return (city, province, region) relation IDs of the
+        features containing a given point. Province and region are
+        only scanned when no city (or province) contains the point.
+        """
+        city = self.cities.locate(point)
+        if city is not None:
+            province = self.city_provinces[city]
+            region = self.city_regions[city]
+        else:
+            province = self.provinces.locate(point)
+            region = self.province_regions.get(province)
+        if region is None:
+            region = self.regions.locate(point)
+        return(city, province, region)
+
+    def locate_many(self, lons, lats):
+        """
+        Return lists of city, province and region relation IDs
+        for arrays of points, resolving the hierarchy like locate.
+        """
+        cities = self.cities.locate_many(lons, lats)
+        provinces = [self.city_provinces.get(x) for x in cities]
+        regions = [self.city_regions.get(x) for x in cities]
+        misses = np.array([x is None for x in cities], dtype=bool)
+        if misses.any():
+            idx = np.flatnonzero(misses)
+            for i, province in zip(idx, self.provinces.locate_many(lons[idx], lats[idx])):
+                provinces[i] = province
+                regions[i] = self.province_regions.get(province)
+        unresolved = np.flatnonzero([x is None for x in regions])
+        if len(unresolved):
+            for i, region in zip(unresolved, self.regions.locate_many(lons[unresolved], lats[unresolved])):
+                regions[i] = region
+        return(cities, provinces, regions)
+
+class CachedLocator():
+    """
+    LRU cache of admin-area lookups in front of a PhilippinesLocator,
+    keyed by centroid quantized to cell_size degrees. A cell's result
+    is only cached when, at every level, the cell is properly inside
+    exactly one feature or touches none; cells that straddle a
+    boundary are remembered as mixed and fall through to the exact
+    lookup.
+    """
+    MIXED = 'mixed'
+
+    def __init__(self, locator, cell_size=0.001, max_cells=100000):
+        self.locator = locator
+        self.national = locator.national
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = collections.OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.mixed = 0
+
+    def stats(self):
+        """Return hit/miss counts and the hit ratio since reset_stats."""
+        lookups = self.hits + self.misses + self.mixed
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'mixed': self.mixed,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'cells': len(self.cells)
+            }
+
+    def contains(self, point):
+        return self.locator.contains(point)
+
+    def contains_many(self, lons, lats):
+        return self.locator.contains_many(lons, lats)
+
+    def cell_is_uniform(self, key):
+        """Return whether every point of a cell gets the same lookup result."""
+        # Pad the cell so points that round onto its edge are covered
+        pad = 1e-9
+        cell = shapely.box(key[0] * self.cell_size - pad,
+                           key[1] * self.cell_size - pad,
+                           (key[0] + 1) * self.cell_size + pad,
+                           (key[1] + 1) * self.cell_size + pad)
+        for admin in (self.locator.cities, self.locator.provinces,
+                      self.locator.regions):
+            hits = admin.tree.query(cell, predicate='intersects')
+            if len(hits) > 1:
+                return False
+            if len(hits) == 1 and not admin.polygons[hits[0]].contains_properly(cell):
+                return False
+        return True
+
+    def locate(self, point):
+        cities, provinces, regions = self.locate_many(
+            np.array([point.x]), np.array([point.y]))
+        return(cities[0], provinces[0], regions[0])
+
+    def locate_many(self, lons, lats):
+        """
+        Return lists of city, province and region relation IDs for
+        arrays of points, looking each cell up in the cache first.
+        """
+        keys = list(zip(np.floor(lons / self.cell_size).astype(np.int64).tolist(),
+                        np.floor(lats / self.cell_size).astype(np.int64).tolist()))
+        results = [None] * len(keys)
+        exact = []
+        for i, key in enumerate(keys):
+            cached = self.cells.get(key)
+            if cached is None:
+                self.misses += 1
+                exact.append(i)
+            elif cached is self.MIXED:
+                self.mixed += 1
+                exact.append(i)
+            else:
+                self.hits += 1
+                self.cells.move_to_end(key)
+                results[i] = cached
+        if exact:
+            idx = np.array(exact)
+            located = zip(*self.locator.locate_many(lons[idx], lats[idx]))
+            for i, result in zip(exact, located):
+                results[i] = result
+                key = keys[i]
+                if key in self.cells:
+                    continue
+                self.cells[key] = result if self.cell_is_uniform(key) else self.MIXED
+                if len(self.cells) > self.max_cells:
+                    self.cells.popitem(last=False)
+        return([x[0] for x in results], [x[1] for x in results],
+               [x[2] for x in results])
+
+class GridLocator():
+    """
+    Precomputed grid over the national envelope. Each cell holds the
+    index of a resolved (city, province, region) triple, or MIXED when
+    the cell straddles a boundary at any level. Only points in mixed
+    cells go to the exact locator.
+    """
+    MIXED = -1
+
+    def __init__(self, locator, grid, triples, min_lon, min_lat, cell_size):
+        self.locator = locator
+        self.national = locator.national
+        self.cities = locator.cities
+        self.provinces = locator.provinces
+        self.regions = locator.regions
+        self.grid = grid
+        self.triples = triples
+        self.min_lon = min_lon
+        self.min_lat = min_lat
+        self.cell_size = cell_size
+
+    @classmethod
+    def build(cls, locator, cell_size=0.01):
+        """Classify every cell of the national envelope with locator."""
+        min_lon, min_lat, max_lon, max_lat = locator.ph_polygon.bounds
+        n_lon = int(np.ceil((max_lon - min_lon) / cell_size))
+        n_lat = int(np.ceil((max_lat - min_lat) / cell_size))
+        cell_lons, cell_lats = np.meshgrid(
+            min_lon + np.arange(n_lon) * cell_size,
+            min_lat + np.arange(n_lat) * cell_size, indexing='ij')
+        cell_lons = cell_lons.ravel()
+        cell_lats = cell_lats.ravel()
+        # Pad cells so points that round onto an edge are covered
+        pad = 1e-9
+        cells = shapely.box(cell_lons - pad, cell_lats - pad,
+                            cell_lons + cell_size + pad, cell_lats + cell_size + pad)
+        uniform = np.ones(len(cells), dtype=bool)
+        for admin in (locator.cities, locator.provinces, locator.regions):
+            # Bounding-box candidates, then predicates with the prepared
+            # polygons as the first argument
+            cell_idx, polygon_idx = admin.tree.query(cells)
+            hit = shapely.intersects(admin.polygons[polygon_idx], cells[cell_idx])
+            cell_idx = cell_idx[hit]
+            polygon_idx = polygon_idx[hit]
+            counts = np.bincount(cell_idx, minlength=len(cells))
+            single = counts[cell_idx] == 1
+            inside = np.zeros(len(cells), dtype=bool)
+            inside[cell_idx[single]] = shapely.contains_properly(
+                admin.polygons[polygon_idx[single]], cells[cell_idx[single]])
+            uniform &= (counts == 0) | inside
+        grid = np.full(len(cells), cls.MIXED, dtype=np.int32)
+        idx = np.flatnonzero(uniform)
+        cities, provinces, regions = locator.locate_many(
+            cell_lons[idx] + cell_size / 2, cell_lats[idx] + cell_size / 2)
+        triples = {}
+        for i, triple in zip(idx, zip(cities, provinces, regions)):
+            grid[i] = triples.setdefault(triple, len(triples))
+        return(cls(locator, grid.reshape(n_lon, n_lat), list(triples),
+                   min_lon, min_lat, cell_size))
+
+    def contains(self, point):
+        return self.locator.contains(point)
+
+    def contains_many(self, lons, lats):
+        return self.locator.contains_many(lons, lats)
+
+    def cell_values(self, lons, lats):
+        i = np.floor((lons - self.min_lon) / self.cell_size).astype(np.int64)
+        j = np.floor((lats - self.min_lat) / self.cell_size).astype(np.int64)
+        on_grid = ((i >= 0) & (i < self.grid.shape[0])
+                   & (j >= 0) & (j < self.grid.shape[1]))
+        values = np.full(len(lons), self.MIXED, dtype=np.int32)
+        values[on_grid] = self.grid[i[on_grid], j[on_grid]]
+        return values
+
+    def locate(self, point):
+        cities, provinces, regions = self.locate_many(
+            np.array([point.x]), np.array([point.y]))
+        return(cities[0], provinces[0], regions[0])
+
+    def locate_many(self, lons, lats):
+        """
+        Return lists of city, province and region relation IDs for
+        arrays of points, from the grid where the cell is resolved.
+        """
+        values = self.cell_values(lons, lats)
+        results = [self.triples[x] if x != self.MIXED else None for x in values]
+        mixed = np.flatnonzero(values == self.MIXED)
+        if len(mixed):
+            located = zip(*self.locator.locate_many(lons[mixed], lats[mixed]))
+            for i, result in zip(mixed, located):
+                results[i] = result
+        return([x[0] for x in results], [x[1] for x in results],
+               [x[2] for x in results])
+
+class VersionedLocator():
+    """
+    Boundary sets in effect over successive date ranges. starts are the
+    ISO valid_from dates of the locators, oldest first (None for the
+    first); each point is located with the set in effect at its date.
+    The national test uses the newest set.
+    """
+    def __init__(self, starts, locators):
+        self.starts = np.array([x or '' for x in starts])
+        self.locators = locators
+        self.national = locators[-1].national
+
+    def set_indexes(self, dates):
+        """Return the index of the boundary set in effect at each date."""
+        dates = np.array([x if isinstance(x, str) else x.isoformat() for x in dates])
+        return np.maximum(np.searchsorted(self.starts, dates, side='right') - 1, 0)
+
+    def contains(self, point):
+        return self.locators[-1].contains(point)
+
+    def contains_many(self, lons, lats):
+        return self.locators[-1].contains_many(lons, lats)
+
+    def locate(self, point, date=None):
+        locator = self.locators[-1] if date is None else self.locators[self.set_indexes([date])[0]]
+        return locator.locate(point)
+
+    def locate_many(self, lons, lats, dates=None):
+        """
+        Return lists of city, province and region relation IDs for
+        arrays of points, each located with the boundary set in effect
+        at its date (the newest set without dates).
+        """
+        if dates is None:
+            return self.locators[-1].locate_many(lons, lats)
+        sets = self.set_indexes(dates)
+        cities, provinces, regions = [None] * len(lons), [None] * len(lons), [None] * len(lons)
+        for k in np.unique(sets):
+            idx = np.flatnonzero(sets == k)
+            located = self.locators[k].locate_many(lons[idx], lats[idx])
+            for i, city, province, region in zip(idx, *located):
+                cities[i], provinces[i], regions[i] = city, province, region
+        return(cities, provinces, regions)
+
+def validate_grid(grid_locator, exact_locator, sample=100000, seed=0):
+    """
+    Compare the grid and exact locators on random points inside the
+    Philippines. Returns (points compared, list of mismatches).
+    """
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = exact_locator.ph_polygon.bounds
+    lons = rng.uniform(min_lon, max_lon, sample)
+    lats = rng.uniform(min_lat, max_lat, sample)
+    inside = check_if_in_philippines_many(exact_locator.ph_polygon, lons, lats)
+    lons = lons[inside]
+    lats = lats[inside]
+    expected = list(zip(*exact_locator.locate_many(lons, lats)))
+    found = list(zip(*grid_locator.locate_many(lons, lats)))
+    mismatches = [(float(lon), float(lat), x, y)
+                  for lon, lat, x, y in zip(lons, lats, expected, found) if x != y]
+    return(len(lons), mismatches)
+
+ISIN_PATTERN = re.compile(r'is_in:?\w*')
+
+@functools.lru_cache(maxsize=1)
+def load_layers(geojson_dir='GeoJSON'):
+    """
+    Return the parsed national and admin-level GeoJSON files, in
+    GEOJSON_LAYERS order. Parsed once per run and shared by the
+    locator and the reference tables.
+    """
+    layers = []
+    for name in GEOJSON_LAYERS:
+        with open(f'{geojson_dir}/{name}.geojson') as f:
+            layers.append(json.load(f))
+    return(tuple(layers))
+
+def read_wikidata(path='geog_tables/wikidataqueryoutput.csv'):
+    """Return the Wikidata city and municipality entries as dicts."""
+    with open(path, newline='', encoding='utf-8') as f:
+        entries = list(csv.DictReader(f))
+    for entry in entries:
+        # Strip 'http://www.wikidata.org/entity/'
+        entry['item'] = entry['item'][31:]
+        entry['population'] = int(entry['population'])
+    return(entries)
+
+def city_reference_rows(features, wikidata):
+    """
+    Match city and municipality features to Wikidata entries, in
+    order of preference: by the feature's wikidata tag, by name and
+    is_in tag, or by name alone if exactly one unmatched entry has it.
+    Returns rows for city_municipality_reference.
+    """
+    by_item = collections.defaultdict(list)
+    by_name_within = collections.defaultdict(list)
+    for entry in wikidata:
+        by_item[entry['item']].append(entry)
+        by_name_within[(entry['itemLabel'].lower(), entry['withinLabel'].lower())].append(entry)
+
+    # One pass sorts the features by what identifies them, collecting
+    # (entry, relation, name, within) matches
+    by_wikidata, by_isin, by_name = [], [], []
+    for feature in features:
+        properties = feature['properties']
+        if 'name' not in properties:
+            continue
+        if 'wikidata' in properties:
+            by_wikidata.extend((entry, properties['@id'], entry['itemLabel'], entry['withinLabel'])
+                               for entry in by_item.get(properties['wikidata'], ()))
+            continue
+        isin_keys = [x for x in properties if ISIN_PATTERN.match(x)]
+        if not isin_keys:
+            by_name.append(properties)
+        # Several is_in keys usually name the same place; the first that
+        # matches is used so a feature yields each entry once
+        for key in isin_keys:
+            entries = by_name_within.get((properties['name'].lower(), properties[key].lower()), ())
+            by_isin.extend((entry, properties['@id'], properties['name'], properties[key])
+                           for entry in entries)
+            if entries:
+                break
+
+    # Names are only trusted if no other unmatched entry shares them
+    matched = set(x[0]['item'] for x in by_wikidata + by_isin)
+    unmatched = [x for x in wikidata if x['item'] not in matched]
+    name_counts = collections.Counter(x['itemLabel'] for x in unmatched)
+    unique_names = {x['itemLabel']: x for x in unmatched if name_counts[x['itemLabel']] == 1}
+    by_name = [(unique_names[x['name']], x['@id'], x['name'], unique_names[x['name']]['withinLabel'])
+               for x in by_name if x['name'] in unique_names]
+    return([(entry['item'][1:], relation_number(relation), name, within,
+             entry['instanceofLabel'], entry['incomeclassLabel'], entry['population'])
+            for entry, relation, name, within in by_wikidata + by_isin + by_name])
+
+def admin_reference_rows(features):
+    """Return (wikidata entry, relation ID, name) rows of named features."""
+    return([(x['properties']['wikidata'][1:], relation_number(x['properties']['@id']), x['properties']['name'])
+            for x in features if 'name' in x['properties']])
+
+def geog_reference_tables(cursor, geojson_dirs=('GeoJSON',)):
+    """
+    Fill the city, province and region reference tables from one or
+    more boundary sets, newest first. A relation in several sets keeps
+    the row of the newest, so areas of superseded sets stay resolvable.
+    """
+    wikidata = read_wikidata()
+    tables = [
+        ('city_municipality_reference',
+         ['wikidata_entry', 'relation_id', 'city_or_mun', 'province_or_region', 'type', 'income_class', 'population']),
+        ('province_reference', ['wikidata_entry', 'relation_id', 'province']),
+        ('region_reference', ['wikidata_entry', 'relation_id', 'region']),
         ]
-    isin_rel_wd.columns = cm_df.columns
-    cm_df = pd.concat([cm_df, isin_rel_wd],
-                                ignore_index=True)
-                                
-    # Remove elements from wikidata df
-    # that are already in geography reference df
-    no_match_mask = wikidata['item'].isin(cm_df['wikidata_entry'])
-    wd_no_match = wikidata[~no_match_mask]
-    wd_no_match_counts = wd_no_match['itemLabel'].value_counts()
-    
-    # Match features without wikidata and "is in" properties 
-    # with wikidata entries if the wikidata entry has no other namesake
-    without_wd_without_isin_wd = [[wd_no_match[wd_no_match['itemLabel']==
-        x['properties']['name']]['item'].values[0],
-        x['properties']['@id'], x['properties']['name'],
-        wd_no_match[wd_no_match['itemLabel']==
-        x['properties']['name']]['withinLabel'].values[0],
-        wd_no_match[wd_no_match['itemLabel']==
-        x['properties']['name']]['instanceofLabel'].values[0],
-        wd_no_match[wd_no_match['itemLabel']==
-        x['properties']['name']]['incomeclassLabel'].values[0],
-        wd_no_match[wd_no_match['itemLabel']==
-        x['properties']['name']]['population'].values[0]]
-        for x in without_wikidata_without_isin
-        if x['properties']['name'] in wd_no_match_counts.index
-        and wd_no_match_counts[x['properties']['name']]==1
-    ]
-    
-    wo_wd_wo_isin_wd_df = pd.DataFrame(without_wd_without_isin_wd,
-                                        columns=cm_df.columns)
-    
-    cm_df = pd.concat([cm_df, wo_wd_wo_isin_wd_df],
-                                axis=0,
-                                ignore_index=True
-                                )
-    cm_df['wikidata_entry'] = cm_df['wikidata_entry'].apply(lambda x: x[1:])
-    cm_df['relation_id'] = cm_df['relation_id'].apply(lambda x: x[9:])
-    cm_df.name = 'city_municipality_reference'
-                                
-    ### PROVINCES
-    provinces_list = [
-        [x['properties']['wikidata'],
-        x['properties']['@id'],
-        x['properties']['name']]
-        for x in ph_p['features'] if 'name' in x['properties']]
-    p_df_cols=['wikidata_entry', 'relation_id', 'province']
-    p_df = pd.DataFrame(provinces_list, columns=p_df_cols)
-    
-    p_df['wikidata_entry'] = p_df['wikidata_entry'].apply(lambda x: x[1:])
-    p_df['relation_id'] = p_df['relation_id'].apply(lambda x: x[9:])
-    p_df.name = 'province_reference'
-    
-    ### REGIONS
-    regions_list = [
-        [x['properties']['wikidata'],
-        x['properties']['@id'],
-        x['properties']['name']]
-        for x in ph_r['features'] if 'name' in x['properties']]
-    r_df_cols=['wikidata_entry', 'relation_id', 'region']
-    r_df = pd.DataFrame(regions_list, columns=r_df_cols)
-    
-    r_df['wikidata_entry'] = r_df['wikidata_entry'].apply(lambda x: x[1:])
-    r_df['relation_id'] = r_df['relation_id'].apply(lambda x: x[9:])
-    r_df.name = 'region_reference'
-    
-    ### Add to database
-    df_list = [cm_df, p_df, r_df]      
-    for df in df_list:
-        tuples = [tuple(x) for x in df.to_numpy()]
+    rows = {table: [] for table, columns in tables}
+    seen = {table: set() for table, columns in tables}
+    # Each set is parsed once for all three tables
+    for geojson_dir in geojson_dirs:
+        ph, ph_r, ph_p, ph_cm = load_layers(geojson_dir)
+        for table, new_rows in (('city_municipality_reference', city_reference_rows(ph_cm['features'], wikidata)),
+                                ('province_reference', admin_reference_rows(ph_p['features'])),
+                                ('region_reference', admin_reference_rows(ph_r['features']))):
+            rows[table].extend(x for x in new_rows if x[1] not in seen[table])
+            seen[table].update(x[1] for x in new_rows)
+    for table, columns in tables:
         query = f"""
-            INSERT INTO {df.name} ({','.join(list(df.columns))}) VALUES %s          
+            INSERT INTO {table} ({','.join(columns)}) VALUES %s
             """
-        extras.execute_values(cursor, query, tuples)
+        extras.execute_values(cursor, query, rows[table])
+    return({table: len(rows[table]) for table, columns in tables})
+
+def rebuild_reference_tables(cursor, geojson_dirs=('GeoJSON',)):
+    """
+    Replace the contents of the reference tables, in the caller's
+    transaction, so readers see either the old or the new tables.
+    """
+    for table in ['city_municipality_reference', 'province_reference', 'region_reference']:
+        cursor.execute(f'DELETE FROM {table}')
+    return(geog_reference_tables(cursor, geojson_dirs))
@@ -0,0 +1,72 @@
+'''
+Post-load index build. Each index is built on a connection of its own
+so the server builds them at the same time, with maintenance settings
+raised for those sessions only.
+
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import queries
+
+def index_statements(createGeometry, partitioned=False):
+    """
+    Return the (name, sql) of each index to build after a load. On
+    partitioned tables the primary key is added by
+    queries.createPartitionedPrimaryKey instead.
+    """
+    statements = list(queries.indexStatements)
+    if partitioned:
+        statements = [x for x in statements if x[0] != 'osm_changeset_pkey']
+    if createGeometry:
+        statements.append(queries.geomIndexStatement)
+    return statements
+
+def build_index(connect, name, sql, workMem, parallelWorkers):
+    """Build one index on a new connection and return (name, seconds)."""
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET maintenance_work_mem = %s', (workMem,))
+        cursor.execute('SET max_parallel_maintenance_workers = %s', (parallelWorkers,))
+        startTime = time.time()
+        cursor.execute(sql)
+        connection.commit()
+        return name, time.time() - startTime
+    finally:
+        connection.close()
+
+def build_indexes(connect, createGeometry, jobs=2, workMem='512MB', parallelWorkers=0, partitioned=False):
+    """
+    Build the post-load indexes, jobs at a time (all with jobs=None),
+    and attach the primary key. connect() returns a new database
+    connection. The server needs about jobs * workMem of memory, and
+    jobs * parallelWorkers parallel workers, whose shared memory comes
+    from /dev/shm. Indexes on partitioned tables are built on every
+    partition.
+    """
+    statements = index_statements(createGeometry, partitioned)
+    jobs = jobs or len(statements)
+    startTime = time.time()
+    print('building {} indexes, {} at a time'.format(len(statements), jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(build_index, connect, name, sql, workMem, parallelWorkers)
+                   for name, sql in statements]
+        for future in as_completed(futures):
+            name, seconds = future.result()
+            print('built {} in {:.1f}s'.format(name, seconds))
+
+    if partitioned:
+        # Cannot be built beforehand and attached on partitioned tables
+        name, seconds = build_index(connect, 'osm_changeset_pkey', queries.createPartitionedPrimaryKey,
+                                    workMem, parallelWorkers)
+        print('built {} in {:.1f}s'.format(name, seconds))
+    else:
+        connection = connect()
+        try:
+            cursor = connection.cursor()
+            print('attaching primary key')
+            cursor.execute(queries.attachPrimaryKey)
+            connection.commit()
+        finally:
+            connection.close()
+    print('indexes built in {:.1f}s'.format(time.time() - startTime))
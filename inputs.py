@@ -0,0 +1,218 @@
+'''
+Opening of changeset dump files for parsing. Dumps may be bzip2, gzip,
+zstandard or uncompressed. bzip2 dumps can be decompressed block by
+block across a process pool.
+
+'''
+import bz2
+import collections
+import gzip
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+    zstdSupport = True
+except ImportError:
+    zstdSupport = False
+
+BLOCK_MAGIC = 0x314159265359
+END_OF_STREAM_MAGIC = 0x177245385090
+SCAN_WINDOW = 1 << 26
+
+def magic_patterns(magic):
+    """
+    Return (shift, middle bytes) for each of the 8 bit alignments of a
+    48-bit magic number. A match starting at bit 8 * (offset - 1) +
+    shift has its middle bytes at offset.
+    """
+    patterns = []
+    for shift in range(8):
+        # Magic placed shift bits into a 56-bit big-endian field
+        field = (magic << (8 - shift)).to_bytes(7, 'big') if shift else magic.to_bytes(6, 'big')
+        patterns.append((shift, field[1:6] if shift else field))
+    return patterns
+
+def find_magic(data, magic, base=0):
+    """
+    Yield bit offsets in data of a 48-bit magic number at any
+    alignment, as bit positions relative to byte offset base.
+    """
+    for shift, middle in magic_patterns(magic):
+        position = data.find(middle)
+        while position != -1:
+            if shift == 0:
+                yield (base + position) * 8
+            elif position >= 1 and position + 6 <= len(data):
+                start = (position - 1) * 8 + shift
+                window = int.from_bytes(data[position - 1:position + 6], 'big')
+                if (window >> (8 - shift)) & ((1 << 48) - 1) == magic:
+                    yield base * 8 + start
+            position = data.find(middle, position + 1)
+
+def bz2_block_ranges(path):
+    """
+    Yield (start bit, end bit) of each compressed block of a bzip2 file
+    (single or multi-stream), in file order.
+    """
+    size = os.path.getsize(path)
+    previous = None
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            # Overlap windows so a magic number across the edge is found
+            data = f.read(SCAN_WINDOW + 8)
+            limit = (offset + SCAN_WINDOW) * 8
+            marks = sorted(
+                [(bit, True) for bit in find_magic(data, BLOCK_MAGIC, offset) if bit < limit]
+                + [(bit, False) for bit in find_magic(data, END_OF_STREAM_MAGIC, offset) if bit < limit])
+            for bit, isBlock in marks:
+                if previous is not None:
+                    yield previous, bit
+                previous = bit if isBlock else None
+            offset += SCAN_WINDOW
+    if previous is not None:
+        yield previous, size * 8
+
+def decompress_block(path, startBit, endBit):
+    """
+    Decompress one bzip2 block by wrapping its bits in a stream of its
+    own: a header, the block, an end-of-stream marker and the block's
+    CRC as the stream CRC.
+    """
+    with open(path, 'rb') as f:
+        f.seek(startBit // 8)
+        data = f.read((endBit + 7) // 8 - startBit // 8)
+    length = endBit - startBit
+    bits = int.from_bytes(data, 'big') >> ((len(data) * 8) - (endBit - startBit // 8 * 8))
+    bits &= (1 << length) - 1
+    blockCrc = (bits >> (length - 80)) & 0xFFFFFFFF
+    stream = (((bits << 48 | END_OF_STREAM_MAGIC) << 32) | blockCrc)
+    streamLength = length + 80
+    padding = -streamLength % 8
+    body = (stream << padding).to_bytes((streamLength + padding) // 8, 'big')
+    return bz2.decompress(b'BZh9' + body)
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """
+    Ordered, read-only stream over a bzip2 file whose blocks are
+    decompressed on a process pool. Blocks that fail to decompress
+    (a magic number that happened to appear inside compressed data)
+    are merged with the following block and retried.
+    """
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.ranges = bz2_block_ranges(path)
+        self.pending = collections.deque()
+        self.buffer = b''
+        self.exhausted = False
+        self.fill()
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        while not self.exhausted and len(self.pending) < 2 * self.workers:
+            try:
+                startBit, endBit = next(self.ranges)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.pending.append((startBit, endBit, self.executor.submit(
+                decompress_block, self.path, startBit, endBit)))
+
+    def next_block(self):
+        startBit, endBit, future = self.pending.popleft()
+        try:
+            return future.result()
+        except (OSError, ValueError, EOFError):
+            pass
+        # Extend the block over following ranges until it decodes
+        while True:
+            self.fill()
+            if not self.pending:
+                raise OSError('invalid bzip2 block at bit {}'.format(startBit))
+            endBit = self.pending.popleft()[1]
+            try:
+                return decompress_block(self.path, startBit, endBit)
+            except (OSError, ValueError, EOFError):
+                continue
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = self.next_block()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+class MeteredReader(io.RawIOBase):
+    """
+    Stream wrapper counting bytes read, for reporting decompressed
+    and compressed throughput.
+    """
+    def __init__(self, raw, compressedSize):
+        self.raw = raw
+        self.compressedSize = compressedSize
+        self.bytesRead = 0
+        self.startTime = time.time()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.raw.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.bytesRead += n
+        return n
+
+    def throughput(self):
+        """Return (decompressed MB/s, compressed MB/s) so far."""
+        elapsed = max(time.time() - self.startTime, 1e-9)
+        return (self.bytesRead / elapsed / 1e6, self.compressedSize / elapsed / 1e6)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+def open_changeset_file(fileName, decompressWorkers=1):
+    """
+    Return a buffered binary file object for a changeset dump, or None
+    if the file's compression is not supported.
+    """
+    if fileName.endswith('.bz2'):
+        if decompressWorkers > 1:
+            raw = ParallelBZ2Reader(fileName, decompressWorkers)
+        else:
+            raw = bz2.BZ2File(fileName)
+    elif fileName.endswith('.gz'):
+        raw = gzip.open(fileName, 'rb')
+    elif fileName.endswith('.zst'):
+        if not zstdSupport:
+            print('ERROR: zstandard support not available. Unzip file first or install zstandard')
+            return None
+        raw = zstandard.ZstdDecompressor().stream_reader(open(fileName, 'rb'))
+    else:
+        raw = open(fileName, 'rb')
+    return io.BufferedReader(MeteredReader(raw, os.path.getsize(fileName)), 1 << 20)
+
+def report_throughput(changesetFile):
+    """Print the throughput of a file from open_changeset_file."""
+    decompressed, compressed = changesetFile.raw.throughput()
+    print('input throughput: {:,.1f} MB/s decompressed, {:,.1f} MB/s compressed'.format(
+        decompressed, compressed))
@@ -0,0 +1,192 @@
+'''
+Timers and counters for the stages of ingest and replication, reported
+as JSON log lines, as a Prometheus textfile or over a local HTTP
+endpoint. Stages:
+
+decompress   reading the (compressed) input
+parse        scanning start tags and parsing accepted changesets
+bbox_reject  the national envelope test on start tags
+national     the national outline test
+locate       admin-area lookup
+flush        loading batches into the database
+commit       committing
+
+'''
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STAGES = ['decompress', 'parse', 'bbox_reject', 'national', 'locate', 'flush', 'commit']
+
+class Metrics():
+    """
+    Stage timers, counters and gauges of one run. With jsonLog or
+    textfile, report() appends a JSON line or rewrites a Prometheus
+    textfile.
+    """
+    def __init__(self, jsonLog=None, textfile=None):
+        self.jsonLog = jsonLog
+        self.textfile = textfile
+        self.startTime = time.time()
+        self.seconds = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(stage, time.perf_counter() - startTime)
+
+    def add_seconds(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def pop_seconds(self):
+        """Return the stage timers and zero them, to pass them between processes."""
+        with self.lock:
+            seconds = dict(self.seconds)
+            self.seconds.clear()
+        return seconds
+
+    def merge_seconds(self, seconds):
+        for stage, value in seconds.items():
+            self.add_seconds(stage, value)
+
+    def record_scan(self, changesetScanner, rejected):
+        """Add the time and counts of a finished scanner.ChangesetScanner."""
+        self.merge_seconds(scan_seconds(changesetScanner))
+        self.count('changesets_parsed', changesetScanner.parsedCount)
+        self.count('changesets_skipped', changesetScanner.skippedCount)
+        for tier, n in rejected.items():
+            self.count('rejected_' + tier, n)
+
+    def snapshot(self):
+        """Return the current metrics, with derived rates, as a dict."""
+        with self.lock:
+            elapsed = time.time() - self.startTime
+            counters = dict(self.counters)
+            result = {
+                'elapsed_seconds': elapsed,
+                'stage_seconds': {x: self.seconds.get(x, 0.0) for x in sorted(set(STAGES) | set(self.seconds))},
+                'counters': counters,
+                'gauges': dict(self.gauges),
+                }
+        parsed = counters.get('changesets_parsed', 0)
+        result['rows_per_second'] = counters.get('changesets_loaded', 0) / elapsed if elapsed > 0 else 0.0
+        result['ph_hit_ratio'] = counters.get('changesets_located', 0) / parsed if parsed else 0.0
+        return result
+
+    def prometheus_text(self):
+        """Return the metrics in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# TYPE changesetmd_stage_seconds_total counter']
+        for stage, seconds in snapshot['stage_seconds'].items():
+            lines.append('changesetmd_stage_seconds_total{{stage="{}"}} {}'.format(stage, seconds))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE changesetmd_{}_total counter'.format(name))
+            lines.append('changesetmd_{}_total {}'.format(name, value))
+        gauges = dict(snapshot['gauges'], elapsed_seconds=snapshot['elapsed_seconds'],
+                      rows_per_second=snapshot['rows_per_second'], ph_hit_ratio=snapshot['ph_hit_ratio'])
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE changesetmd_{} gauge'.format(name))
+            lines.append('changesetmd_{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def report(self, event):
+        """Write the metrics to the configured JSON log and textfile."""
+        if self.jsonLog is not None:
+            line = dict(self.snapshot(), event=event,
+                        time=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+            with open(self.jsonLog, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        if self.textfile is not None:
+            # Written whole and renamed, so collectors never see half a file
+            with open(self.textfile + '.tmp', 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(self.textfile + '.tmp', self.textfile)
+
+def scan_seconds(changesetScanner):
+    """Split the time of a scanner into decompress, bbox_reject and parse."""
+    return {'decompress': changesetScanner.readSeconds,
+            'bbox_reject': changesetScanner.acceptSeconds,
+            'parse': changesetScanner.scanSeconds - changesetScanner.acceptSeconds}
+
+def lag_seconds(timestamp):
+    """Return seconds from a UTC timestamp (naive, aware or ISO text) until now."""
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp[:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (datetime.now(timezone.utc).replace(tzinfo=None) - timestamp).total_seconds()
+
+def serve(metrics, port, host='127.0.0.1'):
+    """
+    Serve metrics on http://host:port/metrics (Prometheus) and
+    /metrics.json from a background thread. Returns the server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, contentType = metrics.prometheus_text(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, contentType = json.dumps(metrics.snapshot()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('serving metrics on http://{}:{}/metrics'.format(host, port))
+    return server
+
+def profiled(function, path):
+    """
+    Wrap function in cProfile, writing the accumulated stats of every
+    call to path (for pstats or snakeviz).
+    """
+    profile = cProfile.Profile()
+
+    def wrapper(*args, **kwargs):
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    return wrapper
@@ -0,0 +1,112 @@
+'''
+Multi-process parsing of changeset dump files. One process decompresses
+and scans the dump, a pool of processes geolocates chunks of it and
+the calling process loads the results into the database.
+
+'''
+import multiprocessing
+import queue
+import boundaries
+import inputs
+import metrics
+import scanner
+
+def readChunks(md, fileName, chunkQueue, workers, batchSize, decompressWorkers, skip):
+    """
+    Scan the dump and put numbered chunks of (attrib, tags, comments)
+    records that pass the envelope test on the chunk queue. The last
+    chunk carries the stage timers of the scan.
+    """
+    # The newest boundary set's outline, as in the serial path
+    national = boundaries.load_locator(boundaries.boundary_sets()[-1][1]).national
+    changesetFile = inputs.open_changeset_file(fileName, decompressWorkers)
+    if changesetFile is None:
+        raise RuntimeError('could not open ' + fileName)
+    changesetScanner = scanner.ChangesetScanner(changesetFile, national.envelope_contains, skip)
+    sequence = 0
+    chunkStart = 0
+    records = []
+    for record in changesetScanner:
+        records.append(record)
+        if len(records) == batchSize:
+            parsedCount = changesetScanner.parsedCount - chunkStart
+            chunkQueue.put((sequence, records, parsedCount, national.rejected['envelope'], {}))
+            national.reset()
+            sequence += 1
+            chunkStart = changesetScanner.parsedCount
+            records = []
+    chunkQueue.put((sequence, records, changesetScanner.parsedCount - chunkStart,
+                    national.rejected['envelope'], metrics.scan_seconds(changesetScanner)))
+    for i in range(workers):
+        chunkQueue.put(None)
+    if skip is not None:
+        print("skipped {:,} changesets already loaded".format(changesetScanner.skippedCount))
+    inputs.report_throughput(changesetFile)
+    changesetFile.close()
+
+def geolocateChunks(md, chunkQueue, resultQueue):
+    """
+    Geolocate chunks from the chunk queue, loading the boundary index
+    once for the life of the process.
+    """
+    locator = md.getLocator()
+    national = locator.national
+    while True:
+        chunk = chunkQueue.get()
+        if chunk is None:
+            resultQueue.put(None)
+            return
+        sequence, records, parsedCount, envelopeRejected, seconds = chunk
+        national.reset()
+        rows = []
+        comments = []
+        md.geolocateRecords(locator, records, rows, comments)
+        rejected = dict(national.rejected, envelope=envelopeRejected)
+        for stage, value in md.metrics.pop_seconds().items():
+            seconds[stage] = seconds.get(stage, 0.0) + value
+        resultQueue.put((sequence, rows, comments, parsedCount, rejected, seconds))
+
+def geolocatedChunks(md, fileName, workers, batchSize, decompressWorkers=1, skip=None):
+    """
+    Yield (rows, comments, parsedCount, rejected, stage seconds) for
+    each chunk of the dump, in file order.
+    """
+    chunkQueue = multiprocessing.Queue(maxsize=2 * workers)
+    resultQueue = multiprocessing.Queue(maxsize=2 * workers)
+    processes = [multiprocessing.Process(
+        target=readChunks,
+        args=(md, fileName, chunkQueue, workers, batchSize, decompressWorkers, skip))]
+    for i in range(workers):
+        processes.append(multiprocessing.Process(
+            target=geolocateChunks,
+            args=(md, chunkQueue, resultQueue)))
+    # Not daemonic, so the reader can run its own decompression pool;
+    # the finally block below makes sure none outlive this generator.
+    for process in processes:
+        process.start()
+
+    pending = {}
+    nextSequence = 0
+    finished = 0
+    try:
+        while finished < workers:
+            try:
+                result = resultQueue.get(timeout=1)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('a parsing process exited unexpectedly')
+                continue
+            if result is None:
+                finished += 1
+                continue
+            pending[result[0]] = result[1:]
+            # Workers finish out of order; hold chunks back until
+            # every earlier one has been yielded.
+            while nextSequence in pending:
+                yield pending.pop(nextSequence)
+                nextSequence += 1
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
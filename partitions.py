@@ -0,0 +1,70 @@
+'''
+Monthly range partitions of osm_changeset (by created_at) and
+osm_changeset_comment (by comment_date). Partitions are created on
+demand before each batch is loaded, and pick up the indexes defined on
+the partitioned tables.
+
+'''
+PARTITIONED_TABLES = ['osm_changeset', 'osm_changeset_comment']
+
+def month_of(timestamp):
+    """Return (year, month) of an OSM timestamp string or datetime."""
+    if isinstance(timestamp, str):
+        return int(timestamp[0:4]), int(timestamp[5:7])
+    return timestamp.year, timestamp.month
+
+def partition_name(table, month):
+    return '{}_y{:04d}m{:02d}'.format(table, month[0], month[1])
+
+def month_bounds(month):
+    """Return the first days of a month and the next, as ISO dates."""
+    year, number = month
+    following = (year + 1, 1) if number == 12 else (year, number + 1)
+    return '{:04d}-{:02d}-01'.format(*month), '{:04d}-{:02d}-01'.format(*following)
+
+def is_partitioned(cursor):
+    """Return whether osm_changeset is a partitioned table."""
+    cursor.execute('''SELECT count(*) FROM pg_partitioned_table pt
+                      JOIN pg_class c ON c.oid = pt.partrelid
+                      WHERE c.relname = 'osm_changeset' ''')
+    return cursor.fetchone()[0] > 0
+
+class PartitionManager():
+    """
+    Creates the monthly partitions missing for a batch. Partitions
+    already in the database are read once and remembered.
+    """
+    def __init__(self, existing):
+        self.existing = set(existing)
+
+    @classmethod
+    def from_connection(cls, connection):
+        """Return a PartitionManager, or None if the tables are not partitioned."""
+        cursor = connection.cursor()
+        if not is_partitioned(cursor):
+            cursor.close()
+            return None
+        cursor.execute('''SELECT c.relname FROM pg_inherits i
+                          JOIN pg_class c ON c.oid = i.inhrelid
+                          JOIN pg_class p ON p.oid = i.inhparent
+                          WHERE p.relname = ANY(%s)''', (PARTITIONED_TABLES,))
+        existing = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return cls(existing)
+
+    def ensure(self, cursor, table, timestamps):
+        """Create the partitions of table covering timestamps that do not exist yet."""
+        for month in sorted(set(month_of(x) for x in timestamps)):
+            name = partition_name(table, month)
+            if name in self.existing:
+                continue
+            lower, upper = month_bounds(month)
+            cursor.execute('''CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+                              FOR VALUES FROM ('{}') TO ('{}')'''.format(name, table, lower, upper))
+            print('created partition {}'.format(name))
+            self.existing.add(name)
+
+    def ensure_batch(self, cursor, changesets, comments):
+        """Create the partitions for a batch of changeset and comment rows."""
+        self.ensure(cursor, 'osm_changeset', [row[2] for row in changesets])
+        self.ensure(cursor, 'osm_changeset_comment', [row[3] for row in comments])
@@ -0,0 +1,194 @@
+'''
+In-database admin-area lookup. The boundary sets are loaded into
+GIST-indexed PostGIS tables, together with the city and province
+containment tables of geog.PhilippinesLocator, and each batch of
+centroids is located with one spatial join instead of in Python. The
+national filter stays in Python, as the scanner needs it before a
+changeset is parsed.
+
+Polygons are repaired with ST_MakeValid and subdivided before loading,
+and points are matched with ST_Intersects, so a point exactly on a
+boundary can be located where the Python locator finds nothing.
+compare() reports such differences.
+
+'''
+import json
+import time
+import numpy as np
+import psycopg2
+import psycopg2.extras
+import boundaries
+import geog
+import queries
+
+LEVELS = [('regions', 'region'), ('provinces', 'province'), ('cities', 'city')]
+
+def relation_id(relation):
+    return int(geog.relation_number(relation)) if relation else None
+
+def source_header(valid_from, geojson_dir):
+    return json.dumps({'valid_from': valid_from,
+                       'sources': boundaries.source_hashes(geojson_dir),
+                       'stats': boundaries.source_stats(geojson_dir)})
+
+def boundaries_current(cursor, sets):
+    """Return whether the boundary tables hold the given boundary sets."""
+    cursor.execute("SELECT to_regclass('osm_admin_set') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return False
+    cursor.execute('SELECT directory, sources FROM osm_admin_set ORDER BY set_id')
+    stored = cursor.fetchall()
+    if len(stored) != len(sets):
+        return False
+    for (directory, header), (valid_from, geojson_dir) in zip(stored, sets):
+        header = json.loads(header)
+        if (directory != geojson_dir or header['valid_from'] != valid_from
+                or not boundaries.is_current(header, geojson_dir)):
+            return False
+    return True
+
+def load_boundaries(connection, sets):
+    """
+    Replace the contents of the boundary tables with the boundary
+    sets, in one transaction. Returns the number of polygon pieces.
+    """
+    cursor = connection.cursor()
+    cursor.execute(queries.createAdminBoundaryTables)
+    cursor.execute('TRUNCATE osm_admin_set, osm_admin_boundary, osm_admin_parent')
+    for set_id, (valid_from, geojson_dir) in enumerate(sets):
+        locator = boundaries.load_locator(geojson_dir)
+        cursor.execute('INSERT INTO osm_admin_set VALUES (%s, %s, %s, %s)',
+                       (set_id, valid_from or '-infinity', geojson_dir, source_header(valid_from, geojson_dir)))
+        for attribute, level in LEVELS:
+            admin = getattr(locator, attribute)
+            psycopg2.extras.execute_values(cursor, queries.insertAdminBoundaries, [
+                (set_id, level, relation_id(relation), position, psycopg2.Binary(polygon.wkb))
+                for position, (relation, polygon) in enumerate(zip(admin.relation_ids, admin.polygons))],
+                template='(%s::smallint, %s, %s::integer, %s::integer, %s::bytea)')
+        parents = [(set_id, 'city', relation_id(x), relation_id(locator.city_provinces.get(x)),
+                    relation_id(locator.city_regions.get(x))) for x in locator.cities.relation_ids]
+        parents += [(set_id, 'province', relation_id(x), None, relation_id(locator.province_regions.get(x)))
+                    for x in locator.provinces.relation_ids]
+        # Duplicate features in a layer share their parents
+        psycopg2.extras.execute_values(cursor, '''INSERT INTO osm_admin_parent VALUES %s
+                                                  ON CONFLICT DO NOTHING''', parents)
+    cursor.execute('ANALYZE osm_admin_boundary')
+    cursor.execute('ANALYZE osm_admin_parent')
+    cursor.execute('SELECT count(*) FROM osm_admin_boundary')
+    pieces = cursor.fetchone()[0]
+    connection.commit()
+    cursor.close()
+    return pieces
+
+def ensure_boundaries(connection, sets=None, reload=False):
+    """Load the boundary sets into the database unless they are there already."""
+    sets = sets or boundaries.boundary_sets()
+    cursor = connection.cursor()
+    current = boundaries_current(cursor, sets)
+    connection.rollback()
+    cursor.close()
+    if current and not reload:
+        return
+    print('loading boundaries into PostGIS')
+    pieces = load_boundaries(connection, sets)
+    print('loaded {} boundary sets as {:,} polygon pieces'.format(len(sets), pieces))
+
+class PostgisLocator():
+    """
+    Admin-area lookup against the boundary tables, with the interface
+    of geog.PhilippinesLocator. connect() returns a new database
+    connection; it is opened on first use, so the locator can be
+    passed to worker processes. Points are located with the boundary
+    set in effect at their date, or the newest without one.
+    """
+    def __init__(self, connect, national_locator):
+        self.connect = connect
+        self.national = national_locator.national
+        self.ph_polygon = national_locator.ph_polygon
+        self.connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def cursor(self):
+        if self.connection is None:
+            self.connection = self.connect()
+            self.connection.autocommit = True
+        return self.connection.cursor()
+
+    def contains(self, point):
+        return geog.check_if_in_philippines(self.ph_polygon, point)
+
+    def contains_many(self, lons, lats):
+        return self.national.contains_many(lons, lats)
+
+    def locate(self, point, date=None):
+        cities, provinces, regions = self.locate_many(
+            np.array([point.x]), np.array([point.y]), None if date is None else [date])
+        return(cities[0], provinces[0], regions[0])
+
+    def locate_many(self, lons, lats, dates=None):
+        """
+        Return lists of city, province and region relation IDs for
+        arrays of points, from one spatial join in the database.
+        """
+        cities, provinces, regions = [None] * len(lons), [None] * len(lons), [None] * len(lons)
+        if len(lons) == 0:
+            return(cities, provinces, regions)
+        if dates is None:
+            dates = [None] * len(lons)
+        cursor = self.cursor()
+        located = psycopg2.extras.execute_values(
+            cursor, queries.locateAdminAreas,
+            [(i, float(lon), float(lat), date) for i, (lon, lat, date) in enumerate(zip(lons, lats, dates))],
+            template='(%s, %s::float8, %s::float8, %s::timestamp)', page_size=len(lons), fetch=True)
+        cursor.close()
+        for i, city, province, region in located:
+            cities[i], provinces[i], regions[i] = (None if x is None else 'relation/' + str(x)
+                                                   for x in (city, province, region))
+        return(cities, provinces, regions)
+
+def load_locator(connect, sets=None):
+    """Return a PostgisLocator whose national filter is the newest boundary set's."""
+    sets = sets or boundaries.boundary_sets()
+    return PostgisLocator(connect, boundaries.load_locator(sets[-1][1]))
+
+def compare(postgis_locator, exact_locator, sample=100000, seed=0, batch_size=20000):
+    """
+    Locate random points in the Philippines, with random dates across
+    the boundary sets, with both locators. Returns (points compared,
+    seconds of each locator, list of mismatches).
+    """
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = postgis_locator.ph_polygon.bounds
+    lons = rng.uniform(min_lon, max_lon, sample)
+    lats = rng.uniform(min_lat, max_lat, sample)
+    inside = postgis_locator.contains_many(lons, lats)
+    lons, lats = lons[inside], lats[inside]
+    versioned = isinstance(exact_locator, geog.VersionedLocator)
+    dates = [None] * len(lons)
+    if versioned:
+        # Spread over a year either side of the dated sets
+        starts = np.array([x for x in exact_locator.starts if x], dtype='datetime64[D]')
+        first = starts.min() - np.timedelta64(365, 'D')
+        span = int((starts.max() - first) / np.timedelta64(1, 'D')) + 365
+        dates = [str(x) + 'T00:00:00' for x in first + rng.integers(0, span, len(lons)).astype('timedelta64[D]')]
+    seconds = {'exact': 0.0, 'postgis': 0.0}
+    mismatches = []
+    for start in range(0, len(lons), batch_size):
+        batch = slice(start, start + batch_size)
+        startTime = time.perf_counter()
+        if versioned:
+            expected = exact_locator.locate_many(lons[batch], lats[batch], dates[batch])
+        else:
+            expected = exact_locator.locate_many(lons[batch], lats[batch])
+        seconds['exact'] += time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        found = postgis_locator.locate_many(lons[batch], lats[batch], dates[batch])
+        seconds['postgis'] += time.perf_counter() - startTime
+        for lon, lat, date, x, y in zip(lons[batch], lats[batch], dates[batch], zip(*expected), zip(*found)):
+            if x != y:
+                mismatches.append((float(lon), float(lat), date, x, y))
+    return(len(lons), seconds, mismatches)
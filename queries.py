@@ -3,8 +3,7 @@ Just a utility file to store some SQL queries for easy reference
 
 @author: Toby Murray
 '''
-createChangesetTable = '''CREATE EXTENSION IF NOT EXISTS hstore;
-CREATE TABLE osm_changeset (
+changesetColumns = '''
   id bigint,
   user_id bigint,
   created_at timestamp without time zone,
@@ -22,15 +21,17 @@ CREATE TABLE osm_changeset (
   province_id integer,
   region_id integer,
   tags hstore
-);
-CREATE TABLE osm_changeset_comment (
+'''
+
+commentColumns = '''
   comment_changeset_id bigint not null,
   comment_user_id bigint not null,
   comment_user_name varchar(255) not null,
   comment_date timestamp without time zone not null,
   comment_text text not null
-);
-CREATE TABLE osm_changeset_state (
+'''
+
+createSupportTables = '''CREATE TABLE osm_changeset_state (
   last_sequence bigint,
   last_timestamp timestamp without time zone,
   update_in_progress smallint
@@ -56,25 +57,132 @@ CREATE TABLE region_reference (
 );
 '''
 
+createChangesetTable = ('CREATE EXTENSION IF NOT EXISTS hstore;\n'
+  + 'CREATE TABLE osm_changeset (' + changesetColumns + ');\n'
+  + 'CREATE TABLE osm_changeset_comment (' + commentColumns + ');\n'
+  + createSupportTables)
+
+# Monthly range partitions are created on demand by partitions.py
+createPartitionedChangesetTable = ('CREATE EXTENSION IF NOT EXISTS hstore;\n'
+  + 'CREATE TABLE osm_changeset (' + changesetColumns + ') PARTITION BY RANGE (created_at);\n'
+  + 'CREATE TABLE osm_changeset_comment (' + commentColumns + ') PARTITION BY RANGE (comment_date);\n'
+  + createSupportTables)
+
+# Daily summaries maintained by rollups.py
+createRollupTables = '''CREATE TABLE IF NOT EXISTS osm_changeset_daily_user (
+  day date not null,
+  region_id integer not null,
+  province_id integer not null,
+  city_id integer not null,
+  user_id bigint not null,
+  changesets integer not null,
+  num_changes bigint not null,
+  PRIMARY KEY (day, region_id, province_id, city_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS osm_changeset_daily_editor (
+  day date not null,
+  region_id integer not null,
+  province_id integer not null,
+  city_id integer not null,
+  editor text not null,
+  changesets integer not null,
+  num_changes bigint not null,
+  PRIMARY KEY (day, region_id, province_id, city_id, editor)
+);
+'''
+
 initStateTable = '''INSERT INTO osm_changeset_state VALUES (-1, null, 0)''';
 
 dropIndexes = '''ALTER TABLE osm_changeset DROP CONSTRAINT IF EXISTS osm_changeset_pkey CASCADE;
 DROP INDEX IF EXISTS user_name_idx, user_id_idx, created_idx, tags_idx, changeset_geom_gist ;
 '''
 
-createConstraints = '''ALTER TABLE osm_changeset ADD CONSTRAINT osm_changeset_pkey PRIMARY KEY(id);'''
+# Post-load indexes, built concurrently on separate connections. The
+# primary key is built as a unique index and attached afterwards, as
+# ALTER TABLE would lock out the other builds.
+indexStatements = [
+  ('osm_changeset_pkey', 'CREATE UNIQUE INDEX osm_changeset_pkey ON osm_changeset(id)'),
+  ('user_name_idx', 'CREATE INDEX user_name_idx ON osm_changeset(user_name)'),
+  ('user_id_idx', 'CREATE INDEX user_id_idx ON osm_changeset(user_id)'),
+  ('created_idx', 'CREATE INDEX created_idx ON osm_changeset(created_at)'),
+  ('tags_idx', 'CREATE INDEX tags_idx ON osm_changeset USING GIN(tags)'),
+]
 
-createIndexes = '''CREATE INDEX user_name_idx ON osm_changeset(user_name);
-CREATE INDEX user_id_idx ON osm_changeset(user_id);
-CREATE INDEX created_idx ON osm_changeset(created_at);
-CREATE INDEX tags_idx ON osm_changeset USING GIN(tags);
-'''
+geomIndexStatement = ('changeset_geom_gist', 'CREATE INDEX changeset_geom_gist ON osm_changeset USING GIST(geom)')
+
+attachPrimaryKey = '''ALTER TABLE osm_changeset ADD CONSTRAINT osm_changeset_pkey PRIMARY KEY USING INDEX osm_changeset_pkey;'''
+
+# The primary key of a partitioned table must include the partition key
+createPartitionedPrimaryKey = '''ALTER TABLE osm_changeset ADD CONSTRAINT osm_changeset_pkey PRIMARY KEY (id, created_at);'''
 
 createGeometryColumn = '''
 CREATE EXTENSION IF NOT EXISTS postgis;
 SELECT AddGeometryColumn('osm_changeset','geom', 4326, 'POLYGON', 2);
 '''
 
-createGeomIndex = '''
-CREATE INDEX changeset_geom_gist ON osm_changeset USING GIST(geom);
+createPartitionedGeometryColumn = '''
+CREATE EXTENSION IF NOT EXISTS postgis;
+ALTER TABLE osm_changeset ADD COLUMN geom geometry(POLYGON, 4326);
+'''
+
+# Admin boundaries for the PostGIS locator (postgis.py). Polygons are
+# subdivided so each index probe tests a small piece.
+createAdminBoundaryTables = '''CREATE EXTENSION IF NOT EXISTS postgis;
+CREATE TABLE IF NOT EXISTS osm_admin_set (
+  set_id smallint PRIMARY KEY,
+  valid_from timestamp without time zone not null,
+  directory text not null,
+  sources text not null
+);
+CREATE TABLE IF NOT EXISTS osm_admin_boundary (
+  set_id smallint not null,
+  level text not null,
+  relation_id integer not null,
+  position integer not null,
+  geom geometry(Geometry, 4326) not null
+);
+CREATE TABLE IF NOT EXISTS osm_admin_parent (
+  set_id smallint not null,
+  level text not null,
+  relation_id integer not null,
+  province_id integer,
+  region_id integer,
+  PRIMARY KEY (set_id, level, relation_id)
+);
+CREATE INDEX IF NOT EXISTS osm_admin_boundary_gist ON osm_admin_boundary USING GIST(geom);
+'''
+
+insertAdminBoundaries = '''INSERT INTO osm_admin_boundary (set_id, level, relation_id, position, geom)
+SELECT v.set_id, v.level, v.relation_id, v.position,
+       ST_Subdivide(ST_CollectionExtract(ST_MakeValid(ST_GeomFromWKB(v.wkb, 4326)), 3), 255)
+FROM (VALUES %s) AS v(set_id, level, relation_id, position, wkb)
+'''
+
+# Mirrors geog.PhilippinesLocator.locate_many: a city fixes the province
+# and region; otherwise the province fixes the region; any level left
+# unresolved is looked up on its own. The first feature in file order
+# wins where features overlap.
+locateAdminAreas = '''SELECT v.i, city.relation_id,
+       CASE WHEN city.relation_id IS NULL THEN province.relation_id ELSE cp.province_id END,
+       COALESCE(CASE WHEN city.relation_id IS NULL THEN pp.region_id ELSE cp.region_id END, region.relation_id)
+FROM (VALUES %s) AS v(i, lon, lat, created_at)
+CROSS JOIN LATERAL (
+  SELECT ST_SetSRID(ST_MakePoint(v.lon, v.lat), 4326) AS geom,
+         (SELECT s.set_id FROM osm_admin_set s WHERE s.valid_from <= COALESCE(v.created_at, 'infinity')
+          ORDER BY s.valid_from DESC LIMIT 1) AS set_id) p
+LEFT JOIN LATERAL (
+  SELECT b.relation_id FROM osm_admin_boundary b
+  WHERE b.set_id = p.set_id AND b.level = 'city' AND ST_Intersects(b.geom, p.geom)
+  ORDER BY b.position LIMIT 1) city ON true
+LEFT JOIN osm_admin_parent cp ON cp.set_id = p.set_id AND cp.level = 'city' AND cp.relation_id = city.relation_id
+LEFT JOIN LATERAL (
+  SELECT b.relation_id FROM osm_admin_boundary b
+  WHERE city.relation_id IS NULL AND b.set_id = p.set_id AND b.level = 'province' AND ST_Intersects(b.geom, p.geom)
+  ORDER BY b.position LIMIT 1) province ON true
+LEFT JOIN osm_admin_parent pp ON pp.set_id = p.set_id AND pp.level = 'province' AND pp.relation_id = province.relation_id
+LEFT JOIN LATERAL (
+  SELECT b.relation_id FROM osm_admin_boundary b
+  WHERE CASE WHEN city.relation_id IS NULL THEN pp.region_id ELSE cp.region_id END IS NULL
+    AND b.set_id = p.set_id AND b.level = 'region' AND ST_Intersects(b.geom, p.geom)
+  ORDER BY b.position LIMIT 1) region ON true
 '''
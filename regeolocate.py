@@ -0,0 +1,179 @@
+'''
+Bulk re-geolocation of loaded changesets after the boundaries change.
+Only changesets whose centroid lies where two boundary sets disagree
+can have different admin areas, so the union of those differences is
+computed once and rows outside it are never looked at. The date window
+is split into slices that are updated in parallel, each in its own
+transaction, with batched UPDATEs of the rows whose areas changed. The
+rollup tables are adjusted by the same rows.
+
+'''
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import numpy as np
+import psycopg2
+import psycopg2.extras
+import shapely
+import boundaries
+import geog
+import rollups
+
+LEVELS = ['regions', 'provinces', 'cities']
+
+def changed_area(old, new):
+    """
+    Return the area where two PhilippinesLocators can disagree: the
+    whole of features only one of them has, and the symmetric
+    difference of features whose geometry changed. None if nothing
+    changed.
+    """
+    pieces = []
+    for level in LEVELS:
+        old_polygons = dict(zip(getattr(old, level).relation_ids, getattr(old, level).polygons))
+        new_polygons = dict(zip(getattr(new, level).relation_ids, getattr(new, level).polygons))
+        for relation in old_polygons.keys() | new_polygons.keys():
+            before, after = old_polygons.get(relation), new_polygons.get(relation)
+            if before is None or after is None:
+                pieces.append(after if before is None else before)
+            elif not shapely.equals_exact(before, after):
+                pieces.append(shapely.symmetric_difference(before, after))
+    if not pieces:
+        return None
+    area = shapely.union_all(pieces)
+    return None if area.is_empty else area
+
+def boundary_changes(previous_dir=None):
+    """
+    Return the union of the changed areas between consecutive boundary
+    sets, and between previous_dir (the boundaries the rows were loaded
+    with) and the oldest set.
+    """
+    locators = [boundaries.load_locator(geojson_dir) for valid_from, geojson_dir in boundaries.boundary_sets()]
+    if previous_dir is not None:
+        locators.insert(0, boundaries.load_locator(previous_dir))
+    areas = [changed_area(old, new) for old, new in zip(locators, locators[1:])]
+    areas = [x for x in areas if x is not None]
+    return shapely.union_all(areas) if areas else None
+
+def time_slices(since, until, days):
+    """Split [since, until) into slices of the given number of days."""
+    slices = []
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=days), until)
+        slices.append((start, end))
+        start = end
+    return slices
+
+# Per process state, set by init_worker
+worker = {}
+
+def init_worker(connectArgs, areaWkb):
+    worker['connectArgs'] = connectArgs
+    worker['area'] = shapely.from_wkb(areaWkb)
+    shapely.prepare(worker['area'])
+    worker['locator'] = boundaries.load_versioned_locator()
+
+def located_updates(locator, area, rows):
+    """
+    Return (id, created_at, city_id, province_id, region_id) of the
+    rows in area whose admin areas differ under locator, and the rows
+    themselves.
+    """
+    lons = np.array([x[1] for x in rows], dtype=float)
+    lats = np.array([x[2] for x in rows], dtype=float)
+    idx = np.flatnonzero(shapely.contains_xy(area, lons, lats))
+    if not len(idx):
+        return [], []
+    if isinstance(locator, geog.VersionedLocator):
+        located = locator.locate_many(lons[idx], lats[idx], [rows[i][3] for i in idx])
+    else:
+        located = locator.locate_many(lons[idx], lats[idx])
+    updates, changed = [], []
+    for i, city, province, region in zip(idx, *located):
+        ids = tuple(int(geog.relation_number(x)) if x else None for x in (city, province, region))
+        if ids != tuple(rows[i][7:10]):
+            updates.append((rows[i][0], rows[i][3]) + ids)
+            changed.append(rows[i])
+    return updates, changed
+
+def regeolocate_slice(since, until, batchSize=20000):
+    """
+    Re-geolocate the changesets created in [since, until) whose
+    centroid is in the changed area. Returns (rows examined, rows
+    updated).
+    """
+    connection = psycopg2.connect(**worker['connectArgs'])
+    cursor = connection.cursor()
+    hasRollups = rollups.rollup_exists(cursor)
+    min_lon, min_lat, max_lon, max_lat = worker['area'].bounds
+    reader = connection.cursor('regeolocate_source')
+    reader.itersize = batchSize
+    reader.execute('''SELECT id, centroid_lon, centroid_lat, created_at, user_id, num_changes,
+                             tags -> 'created_by', city_id, province_id, region_id
+                      FROM osm_changeset
+                      WHERE created_at >= %s AND created_at < %s
+                        AND centroid_lon BETWEEN %s AND %s AND centroid_lat BETWEEN %s AND %s''',
+                   (since, until, min_lon, max_lon, min_lat, max_lat))
+    examined = 0
+    updates, delta = [], rollups.RollupDelta()
+    while True:
+        rows = reader.fetchmany(batchSize)
+        if not rows:
+            break
+        examined += len(rows)
+        batchUpdates, changed = located_updates(worker['locator'], worker['area'], rows)
+        updates += batchUpdates
+        if hasRollups:
+            delta.add([(x[3], x[4], x[5], x[7], x[8], x[9], x[6]) for x in changed], -1)
+            delta.add([(x[3], x[4], x[5], u[2], u[3], u[4], x[6]) for x, u in zip(changed, batchUpdates)])
+    reader.close()
+    for i in range(0, len(updates), batchSize):
+        psycopg2.extras.execute_values(cursor, '''UPDATE osm_changeset AS c
+                SET city_id = v.city_id, province_id = v.province_id, region_id = v.region_id
+                FROM (VALUES %s) AS v(id, created_at, city_id, province_id, region_id)
+                WHERE c.id = v.id AND c.created_at = v.created_at''',
+            updates[i:i + batchSize],
+            template='(%s::bigint, %s::timestamp, %s::integer, %s::integer, %s::integer)',
+            page_size=batchSize)
+    if hasRollups:
+        delta.apply(cursor)
+    connection.commit()
+    connection.close()
+    return examined, len(updates)
+
+def regeolocate(connectArgs, since=None, until=None, workers=1, sliceDays=7, previous_dir=None):
+    """
+    Re-geolocate the changesets created in [since, until) against the
+    boundary sets, in parallel time slices. The window defaults to all
+    loaded changesets, as rows may have been loaded with any set.
+    """
+    area = boundary_changes(previous_dir)
+    if area is None:
+        print('no boundary changes to apply')
+        return 0
+    if since is None or until is None:
+        connection = psycopg2.connect(**connectArgs)
+        cursor = connection.cursor()
+        cursor.execute('SELECT min(created_at), max(created_at) FROM osm_changeset')
+        first, last = cursor.fetchone()
+        connection.close()
+        if first is None:
+            print('no changesets loaded')
+            return 0
+        since = since or first
+        until = until or last + timedelta(seconds=1)
+    slices = time_slices(since, until, sliceDays)
+    print('re-geolocating changesets from {} to {} in {} slices'.format(since, until, len(slices)))
+    totalExamined, totalUpdated = 0, 0
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(connectArgs, shapely.to_wkb(area))) as executor:
+        futures = [executor.submit(regeolocate_slice, start, end) for start, end in slices]
+        for (start, end), future in zip(slices, futures):
+            examined, updated = future.result()
+            totalExamined += examined
+            totalUpdated += updated
+            if updated:
+                print('{:%Y-%m-%d} to {:%Y-%m-%d}: {:,} of {:,} candidates updated'.format(start, end, updated, examined))
+    print('re-geolocated {:,} of {:,} candidate changesets'.format(totalUpdated, totalExamined))
+    return totalUpdated
@@ -0,0 +1,82 @@
+'''
+Local on-disk cache of replication files, so a catch-up run that fails
+part way or a reprocessing run only downloads what is missing.
+
+'''
+import hashlib
+import os
+import time
+
+class ReplicationCache():
+    """
+    Replication files stored under the server's AAA/BBB/CCC.osm.gz
+    layout, each with a .sha256 file that is checked on every read.
+    Files older than maxAge seconds, then the oldest files beyond
+    maxBytes in total, are removed by evict.
+    """
+    def __init__(self, directory, maxBytes=None, maxAge=None):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+
+    def path(self, sequenceNumber):
+        sequenceNumber = str(sequenceNumber).zfill(9)
+        return os.path.join(self.directory, sequenceNumber[:3],
+                            sequenceNumber[3:6], sequenceNumber[-3:] + '.osm.gz')
+
+    def get(self, sequenceNumber):
+        """
+        Return the cached contents of a replication file, or None if it
+        is missing or fails checksum verification.
+        """
+        path = self.path(sequenceNumber)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.sha256') as f:
+                checksum = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if hashlib.sha256(data).hexdigest() != checksum:
+            print("discarding corrupt cached replication file " + path)
+            self.remove(path)
+            return None
+        return data
+
+    def put(self, sequenceNumber, data):
+        path = self.path(sequenceNumber)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under temporary names first so a crash never leaves a
+        # file that looks complete
+        for target, contents in [(path, data),
+                                 (path + '.sha256', hashlib.sha256(data).hexdigest().encode())]:
+            with open(target + '.tmp', 'wb') as f:
+                f.write(contents)
+            os.replace(target + '.tmp', target)
+
+    def remove(self, path):
+        for target in [path, path + '.sha256']:
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """Remove expired files, then the oldest until under maxBytes."""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.osm.gz'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        now = time.time()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            expired = self.maxAge is not None and now - mtime > self.maxAge
+            oversize = self.maxBytes is not None and total > self.maxBytes
+            if not (expired or oversize):
+                continue
+            self.remove(path)
+            total -= size
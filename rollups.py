@@ -0,0 +1,112 @@
+'''
+Daily summary tables per admin area, maintained from each loaded batch
+so dashboards need not scan osm_changeset:
+
+osm_changeset_daily_user: changesets and changes per day, area and
+user. The number of rows per day and area is the number of editors.
+
+osm_changeset_daily_editor: changesets and changes per day, area and
+editing software (the created_by tag without its version).
+
+Missing area and user ids are stored as 0. Replication batches are
+applied as deltas: the stored versions of the replaced changesets are
+subtracted and the new versions added.
+
+'''
+import collections
+import re
+import psycopg2.extras
+import queries
+
+EDITOR_VERSION = re.compile(r'[ /]v?\d.*$')
+
+def editor_name(createdBy):
+    """Return the created_by tag without its version, e.g. JOSM for 'JOSM/1.5 (18678 en)'."""
+    if not createdBy:
+        return ''
+    return EDITOR_VERSION.sub('', createdBy).strip()
+
+def day_of(timestamp):
+    if isinstance(timestamp, str):
+        return timestamp[:10]
+    return timestamp.date().isoformat()
+
+def rollup_exists(cursor):
+    """Return whether the rollup tables exist."""
+    cursor.execute("SELECT to_regclass('osm_changeset_daily_user') IS NOT NULL")
+    return cursor.fetchone()[0]
+
+class RollupDelta():
+    """
+    Changes to the rollup tables, accumulated from changesets in the
+    form (created_at, user_id, num_changes, city_id, province_id,
+    region_id, created_by).
+    """
+    def __init__(self):
+        self.users = collections.defaultdict(lambda: [0, 0])
+        self.editors = collections.defaultdict(lambda: [0, 0])
+
+    def add(self, changesets, sign=1):
+        for created_at, user_id, num_changes, city_id, province_id, region_id, createdBy in changesets:
+            area = (day_of(created_at), int(region_id or 0), int(province_id or 0), int(city_id or 0))
+            changes = int(num_changes or 0)
+            for totals, key in ((self.users, area + (int(user_id or 0),)),
+                                (self.editors, area + (editor_name(createdBy),))):
+                totals[key][0] += sign
+                totals[key][1] += sign * changes
+
+    def add_rows(self, rows, sign=1):
+        """Add changeset rows as built by ChangesetMD.changesetRow."""
+        self.add(((row[2], row[1], row[11], row[13], row[14], row[15], row[16].get('created_by'))
+                  for row in rows), sign)
+
+    def apply(self, cursor):
+        """Add the delta to the rollup tables, dropping rows that reach zero."""
+        for table, keyColumn, keyType, totals in (('osm_changeset_daily_user', 'user_id', 'bigint', self.users),
+                                                  ('osm_changeset_daily_editor', 'editor', 'text', self.editors)):
+            # Sorted, so concurrent writers lock rows in the same order
+            values = sorted(key + tuple(total) for key, total in totals.items() if total != [0, 0])
+            if not values:
+                continue
+            psycopg2.extras.execute_values(cursor, f'''INSERT INTO {table} AS t
+                    (day, region_id, province_id, city_id, {keyColumn}, changesets, num_changes)
+                    values %s
+                    ON CONFLICT (day, region_id, province_id, city_id, {keyColumn}) DO UPDATE
+                    SET changesets = t.changesets + EXCLUDED.changesets,
+                        num_changes = t.num_changes + EXCLUDED.num_changes''',
+                values, page_size=len(values))
+            # Only keys this delta decreased can have reached zero
+            decreased = sorted(key for key, total in totals.items() if total[0] < 0)
+            if decreased:
+                psycopg2.extras.execute_values(cursor, f'''DELETE FROM {table}
+                        WHERE (day, region_id, province_id, city_id, {keyColumn}) IN (VALUES %s)
+                          AND changesets <= 0''',
+                    decreased, template=f'(%s::date, %s::integer, %s::integer, %s::integer, %s::{keyType})',
+                    page_size=len(decreased))
+
+def stored_changesets(cursor, ids):
+    """Return the stored versions of changesets, in RollupDelta.add form."""
+    cursor.execute('''SELECT created_at, user_id, num_changes, city_id, province_id, region_id,
+                             tags -> 'created_by'
+                      FROM osm_changeset WHERE id = ANY(%s)''', ([int(x) for x in ids],))
+    return cursor.fetchall()
+
+def rebuild_rollups(connection, batchSize=100000):
+    """Create the rollup tables if needed and fill them from osm_changeset."""
+    cursor = connection.cursor()
+    cursor.execute(queries.createRollupTables)
+    cursor.execute('TRUNCATE osm_changeset_daily_user, osm_changeset_daily_editor')
+    reader = connection.cursor('rollup_source')
+    reader.itersize = batchSize
+    reader.execute('''SELECT created_at, user_id, num_changes, city_id, province_id, region_id,
+                             tags -> 'created_by'
+                      FROM osm_changeset''')
+    delta = RollupDelta()
+    count = 0
+    for row in reader:
+        delta.add([row])
+        count += 1
+    reader.close()
+    delta.apply(cursor)
+    connection.commit()
+    print('rolled up {:,} changesets'.format(count))
@@ -0,0 +1,143 @@
+'''
+Streaming scanner for changeset files. Only the attributes of each
+<changeset> start tag are read with a byte-level scan; lxml is used to
+materialize tags and comments for the changesets that are accepted.
+
+'''
+import re
+import time
+from lxml import etree
+
+CHANGESET_START = re.compile(rb'<changeset[\s>/]')
+START_TAG = re.compile(rb'<changeset\b([^>]*)>')
+ATTRIBUTE = re.compile(rb'([\w:]+)\s*=\s*"([^"]*)"')
+ATTRIBS_USED = [
+    'id', 'uid', 'open', 'created_at', 'closed_at', 'min_lon', 'max_lon',
+    'min_lat', 'max_lat'
+    ]
+REQUIRED = frozenset(x.encode() for x in ATTRIBS_USED)
+
+def read_tags(elem):
+    tags = {}
+    for tag in elem.iterchildren(tag='tag'):
+        tags[tag.attrib['k']] = tag.attrib['v']
+    return tags
+
+def read_comments(elem):
+    comments = []
+    for discussion in elem.iterchildren(tag='discussion'):
+        for commentElement in discussion.iterchildren(tag='comment'):
+            for text in commentElement.iterchildren(tag='text'):
+               text = text.text
+            comment = (elem.attrib['id'], commentElement.attrib.get('uid'),  commentElement.attrib.get('user'), commentElement.attrib.get('date'), text)
+            comments.append(comment)
+    return comments
+
+class Watermark():
+    """
+    Skip test for changesets that are already loaded: those with id
+    and closed_at at or below the loaded maxima.
+    """
+    def __init__(self, maxId, maxClosedAt):
+        self.maxId = maxId
+        self.maxClosedAt = maxClosedAt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def __call__(self, id, closed_at):
+        if isinstance(closed_at, bytes):
+            closed_at = closed_at.decode()
+        return int(id) <= self.maxId and closed_at <= self.maxClosedAt
+
+class ChangesetScanner():
+    """
+    Iterate over (attrib, tags, comments) records of the closed
+    changesets in a file for which accept(min_lon, max_lon, min_lat,
+    max_lat) is true. Rejected changesets never become lxml elements.
+    If given, skip(id, closed_at) drops changesets before the accept
+    test. parsedCount counts every closed changeset seen, and
+    skippedCount those dropped by skip. readSeconds, scanSeconds and
+    acceptSeconds (part of scanSeconds) time reading, scanning and
+    the accept test.
+    """
+    def __init__(self, changesetFile, accept, skip=None, blockSize=1 << 22):
+        self.changesetFile = changesetFile
+        self.accept = accept
+        self.skip = skip
+        self.blockSize = blockSize
+        self.parsedCount = 0
+        self.skippedCount = 0
+        self.readSeconds = 0.0
+        self.scanSeconds = 0.0
+        self.acceptSeconds = 0.0
+
+    def __iter__(self):
+        buffer = b''
+        while True:
+            startTime = time.perf_counter()
+            block = self.changesetFile.read(self.blockSize)
+            self.readSeconds += time.perf_counter() - startTime
+            buffer += block
+            starts = [m.start() for m in CHANGESET_START.finditer(buffer)]
+            if block:
+                # The last changeset may continue in the next block
+                ends = starts[1:]
+            else:
+                end = buffer.rfind(b'</osm>')
+                ends = starts[1:] + [end if end != -1 else len(buffer)]
+            for start, end in zip(starts, ends):
+                startTime = time.perf_counter()
+                record = self.scan(buffer, start, end)
+                self.scanSeconds += time.perf_counter() - startTime
+                if record is not None:
+                    yield record
+            if not block:
+                return
+            # Keep the unfinished changeset, or enough bytes to catch a
+            # start tag split across blocks
+            buffer = buffer[starts[-1]:] if starts else buffer[-16:]
+
+    def scan(self, buffer, start, end):
+        match = START_TAG.match(buffer, start, end)
+        # An odd number of quotes means a '>' inside an attribute value
+        # cut the start tag short; let lxml read those in full.
+        if match is None or match.group(1).count(b'"') % 2:
+            return self.parse(buffer[start:end])
+        attrib = dict(ATTRIBUTE.findall(match.group(1)))
+        if not REQUIRED <= attrib.keys():
+            # ATTRIBUTE only reads double-quoted values
+            if b"'" in match.group(1):
+                return self.parse(buffer[start:end])
+            return None
+        if attrib[b'open'] != b'false':
+            return None
+        self.parsedCount += 1
+        if self.skip is not None and self.skip(attrib[b'id'], attrib[b'closed_at']):
+            self.skippedCount += 1
+            return None
+        startTime = time.perf_counter()
+        accepted = self.accept(attrib[b'min_lon'], attrib[b'max_lon'],
+                               attrib[b'min_lat'], attrib[b'max_lat'])
+        self.acceptSeconds += time.perf_counter() - startTime
+        if not accepted:
+            return None
+        return self.record(etree.fromstring(buffer[start:end]))
+
+    def parse(self, data):
+        elem = etree.fromstring(data)
+        if any(x not in elem.attrib for x in ATTRIBS_USED):
+            return None
+        if elem.attrib['open'] != 'false':
+            return None
+        self.parsedCount += 1
+        if self.skip is not None and self.skip(elem.attrib['id'], elem.attrib['closed_at']):
+            self.skippedCount += 1
+            return None
+        startTime = time.perf_counter()
+        accepted = self.accept(elem.attrib['min_lon'], elem.attrib['max_lon'],
+                               elem.attrib['min_lat'], elem.attrib['max_lat'])
+        self.acceptSeconds += time.perf_counter() - startTime
+        if not accepted:
+            return None
+        return self.record(elem)
+
+    def record(self, elem):
+        return (dict(elem.attrib), read_tags(elem), read_comments(elem))
@@ -0,0 +1,124 @@
+'''
+Lookup of replication sequence numbers by timestamp, by binary search
+over the per-sequence state files of the replication directory.
+
+'''
+import functools
+import os
+import re
+from datetime import datetime
+
+import inputs
+
+LAST_RUN_PATTERN = re.compile(
+    r'last_run:\s*([0-9]{4}-[0-9]{2}-[0-9]{2}[ T][0-9]{2}:[0-9]{2}:[0-9]{2})')
+SEQUENCE_PATTERN = re.compile(r'sequence:\s*([0-9]+)')
+DUMP_TIMESTAMP_PATTERN = re.compile(
+    rb'<osm[^>]*\stimestamp="([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})Z"')
+
+class HttpStateBackend():
+    """Read state files from a replication server."""
+    def __init__(self, baseUrl, session):
+        self.baseUrl = baseUrl
+        self.session = session
+
+    def read(self, path):
+        response = self.session.get(self.baseUrl + path)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text
+
+class DirectoryStateBackend():
+    """Read state files from a local copy of the replication directory."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read(self, path):
+        try:
+            with open(os.path.join(self.directory, path)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+def state_backend(replicationUrl, session):
+    if replicationUrl.startswith(('http://', 'https://')):
+        return HttpStateBackend(replicationUrl, session)
+    return DirectoryStateBackend(replicationUrl)
+
+def state_path(sequenceNumber):
+    sequenceNumber = str(sequenceNumber).zfill(9)
+    return (sequenceNumber[:3] + '/' + sequenceNumber[3:6] + '/'
+            + sequenceNumber[-3:] + '.state.txt')
+
+def parse_last_run(text):
+    return datetime.strptime(
+        LAST_RUN_PATTERN.search(text).group(1).replace('T', ' '),
+        '%Y-%m-%d %H:%M:%S')
+
+def dump_timestamp(fileName):
+    """Return the timestamp in the <osm> tag of a changeset dump."""
+    changesets = inputs.open_changeset_file(fileName)
+    head = changesets.read(4096)
+    changesets.close()
+    return datetime.strptime(
+        DUMP_TIMESTAMP_PATTERN.search(head).group(1).decode(),
+        '%Y-%m-%dT%H:%M:%S')
+
+class SequenceFinder():
+    """
+    Find replication sequences by timestamp in O(log n) state file
+    requests. Fetched states are kept in an LRU cache.
+    """
+    # Early sequences have gaps in their state files; skip this many
+    # missing ones before giving up on a probe.
+    MAX_MISSING = 16
+
+    def __init__(self, backend, cacheSize=256):
+        self.backend = backend
+        self.timestamp = functools.lru_cache(maxsize=cacheSize)(self._timestamp)
+
+    def _timestamp(self, sequenceNumber):
+        """Return last_run of a sequence, or None if it has no state file."""
+        text = self.backend.read(state_path(sequenceNumber))
+        if text is None:
+            return None
+        return parse_last_run(text)
+
+    def latest(self):
+        """Return (sequence, last_run) of the newest sequence."""
+        text = self.backend.read('state.yaml')
+        return (int(SEQUENCE_PATTERN.search(text).group(1)),
+                parse_last_run(text))
+
+    def probe(self, sequenceNumber, upper):
+        """
+        Return (sequence, last_run) of the first sequence at or after
+        sequenceNumber, up to upper, that has a state file.
+        """
+        for candidate in range(sequenceNumber, min(sequenceNumber + self.MAX_MISSING + 1, upper + 1)):
+            ts = self.timestamp(candidate)
+            if ts is not None:
+                return candidate, ts
+        return upper, None
+
+    def find(self, timestamp):
+        """
+        Return the first sequence whose last_run is at or after
+        timestamp, or the newest sequence if none is.
+        """
+        latestSequence, latestTimestamp = self.latest()
+        if latestTimestamp < timestamp:
+            return latestSequence
+        # best is always a sequence with a state file
+        low, high, best = 0, latestSequence, latestSequence
+        while low < high:
+            middle = (low + high) // 2
+            candidate, ts = self.probe(middle, high)
+            if ts is None or ts >= timestamp:
+                if ts is not None:
+                    best = candidate
+                high = middle
+            else:
+                low = candidate + 1
+        return best